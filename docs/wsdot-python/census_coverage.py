@@ -0,0 +1,64 @@
+# Population served by each WSDOT service level, matching the web tool's census roll-up
+# (getGeographyData in src/analysis/wsdot/index.ts): each geography contributes
+# total_population * intersection_ratio, where intersection_ratio is the share of its area inside the union of
+# stop buffers for the level.
+#
+# Used by wsdot.py --census; imported lazily so geopandas is only needed when a census file is given.
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+# Equal-area CRS in meters (NAD83 / Conus Albers), so buffer radii and area ratios are both meaningful statewide
+DEFAULT_CRS = 'EPSG:5070'
+
+def read_geographies(filename, id_column, population_column, crs=DEFAULT_CRS):
+    """Read block groups/tracts, keeping the id, population and geometry, projected to crs"""
+    geographies = gpd.read_file(filename)[[id_column, population_column, 'geometry']]
+    geographies = geographies.to_crs(crs)
+    geographies['area'] = geographies.geometry.area
+    return geographies.reset_index(drop=True)
+
+def stop_buffers(stop_lat, stop_lon, radius, crs=DEFAULT_CRS):
+    """Buffer every stop in one vectorized call"""
+    points = gpd.GeoSeries(gpd.points_from_xy(stop_lon, stop_lat), crs='EPSG:4326').to_crs(crs)
+    return points.buffer(radius)
+
+def level_coverage(buffers, level_masks, geographies, id_column, population_column):
+    """Population inside the dissolved stop buffers of each level
+
+    buffers is aligned with the stop axis of level_masks ({level_column: mask}).
+    Returns one row per (level, intersecting geography) with the geography's
+    total_population, intersection_ratio and intersection_population.
+    """
+    sindex = geographies.sindex
+    population = geographies[population_column].fillna(0).to_numpy(dtype=float)
+    located = (buffers.notna() & ~buffers.is_empty).to_numpy()
+    rows = []
+    for level, mask in level_masks.items():
+        served = buffers[mask & located]
+        if served.empty:
+            continue
+        union = served.unary_union
+        candidates = sindex.query(union, predicate='intersects')
+        if len(candidates) == 0:
+            continue
+        inside = geographies.geometry.iloc[candidates].intersection(union).area.to_numpy()
+        ratio = np.clip(inside / geographies['area'].to_numpy()[candidates], 0, 1)
+        rows.append(pd.DataFrame({
+            'level': level,
+            id_column: geographies[id_column].to_numpy()[candidates],
+            'total_population': population[candidates],
+            'intersection_ratio': ratio,
+            'intersection_population': population[candidates] * ratio,
+        }))
+    if not rows:
+        return pd.DataFrame(columns=['level', id_column, 'total_population', 'intersection_ratio', 'intersection_population'])
+    return pd.concat(rows, ignore_index=True).sort_values(['level', id_column], kind='stable')
+
+def coverage_summary(coverage):
+    """Population served per level"""
+    return coverage.groupby('level', sort=False).agg(
+        geographies=('intersection_ratio', 'size'),
+        intersection_population=('intersection_population', 'sum'),
+    ).reset_index()
@@ -0,0 +1,259 @@
+# Randomized equivalence and timing check of the vectorized classifier in wsdot.py against the legacy
+# process_service_level path.
+#
+# Usage:
+#   python equivalence.py [--runs 50] [--seed 0] [--max-stops 60] [--max-routes 12] [--keep DIR] [--memory-budget MB]
+#
+# Each run writes a small random GTFS feed (weekday and weekend service in one feed, with untimed intermediate stops,
+# stop_sequence numbered from 0 or 1, sometimes with gaps, prefixed, numeric or zero-padded IDs and some routes run
+# from frequencies.txt), draws a random
+# SERVICE_LEVELS-shaped config, loads the feed with transit_service_analyst and classifies it both ways:
+# legacy process_service_level per level, and build_service_matrices + classify_stops. Any stop set
+# that differs is reported, including the legacy quirks (route merges on route_id alone, falling back to route stops
+# when no stop passes the stop-level filters). Both paths are timed, excluding the shared tsa.load_gtfs.
+# With --memory-budget, each feed is also loaded through wsdot.load_services with and without that budget (the spilled
+# scan in place of tsa, with random --service-day-nights), and the matrices, level stop sets and CSV output must be
+# identical. The spilled scan does not expand frequencies.txt, so feeds with one are skipped for that comparison.
+# Exits non-zero on any mismatch.
+
+import argparse
+import contextlib
+import copy
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+import transit_service_analyst as tsa
+
+import wsdot
+
+WEEKDAY_DATE = '20240819'
+WEEKEND_DATE = '20240825'
+LAST_HOUR = 28
+
+def feed_id(style, prefix, i):
+    """An ID the way feeds write them: prefixed ('S_3'), a plain number ('4') or zero-padded ('00004')"""
+    if style == 'prefixed':
+        return f'{prefix}_{i}'
+    return str(i + 1) if style == 'numeric' else f'{i + 1:05d}'
+
+def hms(seconds):
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+def write_feed(path, rng, n_stops, n_routes):
+    """Write a random feed with weekday ('wk') and weekend ('we') service"""
+    os.makedirs(path, exist_ok=True)
+    # tsa reads numeric IDs as integers, so zero-padded ones come back changed ('00004' -> '4')
+    stop_style, trip_style, route_style = (rng.choice(['prefixed', 'prefixed', 'numeric', 'padded']) for _ in range(3))
+    stops = [feed_id(stop_style, 'S', i) for i in range(n_stops)]
+    with open(os.path.join(path, 'agency.txt'), 'w') as f:
+        f.write('agency_id,agency_name,agency_url,agency_timezone\nA,Agency,https://example.com,America/Los_Angeles\n')
+    with open(os.path.join(path, 'stops.txt'), 'w') as f:
+        f.write('stop_id,stop_name,stop_lat,stop_lon\n')
+        for stop in stops:
+            f.write(f'{stop},{stop},{47 + rng.random():.6f},{-122 + rng.random():.6f}\n')
+    with open(os.path.join(path, 'calendar.txt'), 'w') as f:
+        f.write('service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n')
+        f.write('wk,1,1,1,1,1,0,0,20240101,20241231\nwe,0,0,0,0,0,1,1,20240101,20241231\n')
+
+    # Route 0 runs hourly around the clock so every hour_N column exists for the legacy filters
+    patterns = [(rng.sample(stops, 2), 60, 4 * 60, (LAST_HOUR + 1) * 60)]
+    for _ in range(n_routes):
+        start = rng.randint(4 * 60, 10 * 60)
+        patterns.append((
+            rng.sample(stops, rng.randint(2, min(10, n_stops))),
+            rng.choice([7, 10, 12, 15, 20, 30, 45, 60, 90, 120]),
+            start,
+            rng.randint(start + 60, (LAST_HOUR + 1) * 60),
+        ))
+
+    # Only the first and last stops of a trip must be timed; stop_sequence only has to increase
+    timed_share = rng.choice([1, 1, 0.5, 0])
+    first_sequence, sequence_step = rng.choice([0, 1]), rng.choice([1, 1, 5])
+    # Some routes run from frequencies.txt: one fully timed template trip per direction and service. tsa matches
+    # frequencies.txt trip_ids (read as integers when numeric) against its string trip_ids and fails when none
+    # match, so only prefixed trip IDs get frequency routes
+    frequency_routes = {route for route in range(1, len(patterns)) if trip_style == 'prefixed' and rng.random() < 0.3}
+
+    trip, frequencies = 0, []
+    with open(os.path.join(path, 'routes.txt'), 'w') as routes, \
+            open(os.path.join(path, 'trips.txt'), 'w') as trips, \
+            open(os.path.join(path, 'stop_times.txt'), 'w') as stop_times:
+        routes.write('route_id,agency_id,route_short_name,route_type\n')
+        trips.write('route_id,service_id,trip_id,direction_id,shape_id,block_id\n')
+        stop_times.write('trip_id,arrival_time,departure_time,stop_id,stop_sequence\n')
+        for route, (pattern, headway, start, end) in enumerate(patterns):
+            route_id = feed_id(route_style, 'R', route)
+            routes.write(f'{route_id},A,{route},3\n')
+            for direction in (0, 1):
+                sequence = pattern if direction == 0 else pattern[::-1]
+                for service_id in ('wk', 'we'):
+                    minute = start + rng.randint(0, headway - 1)
+                    last = end
+                    if route in frequency_routes:
+                        # One template trip over at least one headway: tsa fails on a frequencies.txt row that rounds
+                        # to no trips
+                        last = max(end, minute + headway)
+                        frequencies.append(f'{feed_id(trip_style, "T", trip)},{hms(60 * minute)},{hms(60 * last)},{60 * headway}\n')
+                    while minute < last:
+                        trip_id = feed_id(trip_style, 'T', trip)
+                        trips.write(f'{route_id},{service_id},{trip_id},{direction},SH_{route}_{direction},\n')
+                        for i, stop in enumerate(sequence):
+                            at = 60 * minute + 150 * i + rng.randint(0, 59)
+                            timed = i in (0, len(sequence) - 1) or route in frequency_routes or rng.random() < timed_share
+                            time = hms(at) if timed else ''
+                            stop_times.write(f'{trip_id},{time},{time},{stop},{first_sequence + sequence_step * i}\n')
+                        trip += 1
+                        if route in frequency_routes:
+                            minute = last
+                        else:
+                            # Route 0 keeps to the hour, or an hour_N column could go missing
+                            minute += headway + (rng.randint(-headway // 4, headway // 4) if route else 0)
+    if frequencies:
+        with open(os.path.join(path, 'frequencies.txt'), 'w') as f:
+            f.write('trip_id,start_time,end_time,headway_secs\n')
+            f.writelines(frequencies)
+
+def random_window(rng, hours, config):
+    window = copy.deepcopy(config)
+    window['hours'] = [f'hour_{hour}' for hour in sorted(rng.sample(hours, rng.randint(1, len(hours))))]
+    window['min_tph'] = rng.randint(0, 4)
+    window['min_total'] = rng.randint(0, 4 * len(window['hours']))
+    return window
+
+def random_levels(rng):
+    """Perturb SERVICE_LEVELS: windows, thresholds and weekend requirement"""
+    levels = copy.deepcopy(wsdot.SERVICE_LEVELS)
+    for config in levels.values():
+        if 'total_trips_threshold' in config:
+            config['total_trips_threshold'] = rng.randint(0, 120)
+            continue
+        for period in ('peak', 'extended', 'weekend'):
+            if period in config and rng.random() < 0.7:
+                config[period] = random_window(rng, list(range(5, 23)), config[period])
+        for segment in config.get('night_segments', []):
+            start = rng.randint(22, LAST_HOUR - 1)
+            segment['hours'] = [f'hour_{start}', f'hour_{start + 1}']
+            segment['min_total'] = rng.randint(0, 3)
+        if 'weekend' in config:
+            config['weekend_required'] = rng.random() < 0.8
+    return levels
+
+def legacy_levels(levels, weekday_service, weekend_service):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return {
+            name: set(wsdot.process_service_level(name, config, weekday_service, weekend_service)['stop_id'])
+            for name, config in levels.items()
+        }
+
+def optimized_levels(levels, weekday_service, weekend_service):
+    n_hours = wsdot.max_config_hour(levels) + 1
+    weekday = wsdot.build_service_matrices(weekday_service, n_hours=n_hours)
+    weekend = wsdot.build_service_matrices(weekend_service, stop_ids=weekday.stop_ids, n_hours=n_hours)
+    evaluations = wsdot.classify_stops(levels, weekday, weekend)
+    return {name: set(weekday.stop_ids[wsdot.level_mask(margins)]) for name, (criteria, margins) in evaluations.items()}
+
+def load_output(path, levels, night_days, memory_budget, directory):
+    """Matrix arrays, level stop sets and CSV bytes from wsdot.load_services on one feed"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        weekday, weekend, timeline, stops, scans = wsdot.load_services(
+            path, path, WEEKDAY_DATE, WEEKEND_DATE, levels, night_days, memory_budget, directory,
+        )
+    arrays = {
+        f'{feed} {name}': array
+        for feed, matrices in (('weekday', weekday), ('weekend', weekend))
+        for name, array in wsdot._matrix_arrays(matrices).items()
+    }
+    evaluations = wsdot.classify_stops(levels, weekday, weekend, timeline, night_days or (0,))
+    level_masks = {levels[name].level_column: wsdot.level_mask(margins) for name, (criteria, margins) in evaluations.items()}
+    coords = stops.drop_duplicates('stop_id').set_index('stop_id').reindex(weekday.stop_ids)
+    filename = os.path.join(directory, 'output.csv')
+    wsdot.write_output(filename, weekday.stop_ids, coords['stop_lat'].to_numpy(dtype=float), coords['stop_lon'].to_numpy(dtype=float), level_masks)
+    with open(filename, 'rb') as f:
+        output = f.read()
+    stop_sets = {column: set(weekday.stop_ids[mask]) for column, mask in level_masks.items()}
+    return arrays, stop_sets, output
+
+def budget_mismatches(path, rng, levels, memory_budget):
+    """Compare load_services on tsa and within memory_budget (MB) for one feed"""
+    night_days = sorted(rng.sample(range(7), rng.randint(1, 3))) if rng.random() < 0.5 else None
+    levels = wsdot.compile_levels(levels)
+    arrays, stop_sets, output = load_output(path, levels, night_days, None, path)
+    budget_arrays, budget_stop_sets, budget_output = load_output(path, levels, night_days, memory_budget, path)
+    mismatches = [
+        (f'{name} matrix', None)
+        for name in sorted(arrays.keys() | budget_arrays.keys())
+        if name not in arrays or name not in budget_arrays or not np.array_equal(arrays[name], budget_arrays[name])
+    ]
+    mismatches += [(f'{column} budgeted', sorted(stop_sets[column] ^ budget_stop_sets.get(column, set()))) for column in stop_sets if stop_sets[column] != budget_stop_sets.get(column)]
+    if output != budget_output:
+        mismatches.append(('budgeted output', None))
+    return mismatches
+
+def run(index, rng, directory, max_stops, max_routes, memory_budget=None):
+    """Generate, classify both ways and compare one random case
+
+    With memory_budget, feeds without frequencies.txt also get budget_mismatches;
+    budgeted is False for the ones skipped.
+    """
+    path = os.path.join(directory, f'feed_{index}')
+    n_stops, n_routes = rng.randint(3, max_stops), rng.randint(1, max_routes)
+    write_feed(path, rng, n_stops, n_routes)
+    levels = random_levels(rng)
+    with contextlib.redirect_stdout(io.StringIO()):
+        weekday_service = tsa.load_gtfs(path, WEEKDAY_DATE)
+        weekend_service = tsa.load_gtfs(path, WEEKEND_DATE)
+
+    start = time.perf_counter()
+    legacy = legacy_levels(levels, weekday_service, weekend_service)
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    optimized = optimized_levels(levels, weekday_service, weekend_service)
+    optimized_seconds = time.perf_counter() - start
+
+    mismatches = [(name, sorted(legacy[name] ^ optimized[name])) for name in levels if legacy[name] != optimized[name]]
+    budgeted = bool(memory_budget) and not os.path.exists(os.path.join(path, 'frequencies.txt'))
+    if budgeted:
+        mismatches += budget_mismatches(path, rng, levels, memory_budget)
+    return n_stops, n_routes, legacy_seconds, optimized_seconds, mismatches, budgeted
+
+def main():
+    parser = argparse.ArgumentParser(description="Randomized equivalence check of the vectorized classifier")
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-stops', type=int, default=60)
+    parser.add_argument('--max-routes', type=int, default=12)
+    parser.add_argument('--keep', metavar='DIR', help="write the feeds under DIR instead of a temporary directory")
+    parser.add_argument('--memory-budget', type=float, metavar='MB', help="also compare wsdot.py's --memory-budget path against the tsa path at this budget; small budgets spill to many partitions (feeds with frequencies.txt are skipped, that path does not expand it)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures, skipped = 0, 0
+    legacy_total, optimized_total = 0.0, 0.0
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = args.keep or scratch
+        for index in range(args.runs):
+            n_stops, n_routes, legacy_seconds, optimized_seconds, mismatches, budgeted = run(
+                index, rng, directory, args.max_stops, args.max_routes, args.memory_budget,
+            )
+            skipped += bool(args.memory_budget) and not budgeted
+            legacy_total += legacy_seconds
+            optimized_total += optimized_seconds
+            status = 'ok' if not mismatches else 'MISMATCH'
+            print(f"run {index}: {n_stops} stops, {n_routes} routes, legacy {legacy_seconds:.3f}s, optimized {optimized_seconds:.3f}s, {status}")
+            for name, stops in mismatches:
+                print(f"  {name}: {len(stops)} stops differ: {stops[:10]}" if stops is not None else f"  {name} differs")
+            failures += bool(mismatches)
+
+    speedup = legacy_total / optimized_total if optimized_total else float('inf')
+    print(f"\n{args.runs - failures}/{args.runs} runs identical; legacy {legacy_total:.2f}s, optimized {optimized_total:.2f}s ({speedup:.1f}x)")
+    if args.memory_budget:
+        print(f"--memory-budget {args.memory_budget} compared on {args.runs - skipped} runs ({skipped} with frequencies.txt skipped)")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
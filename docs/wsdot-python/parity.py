@@ -0,0 +1,216 @@
+# Compare the TypeScript WSDOT report (src/analysis/wsdot, processServiceLevel) against the CSV written by wsdot.py.
+#
+# Usage:
+#   python parity.py <ts_report.json|.ndjson> <wsdot_output.csv> [--cache DIR] [--feed-map map.csv] [--levels PATH]
+#   python parity.py --manifest runs.csv
+#
+# The TS report is either the WSDOTReport JSON ({"stops": [...]}) or NDJSON with one stop (or one {"stops": [...]}
+# chunk) per line. Python stop_ids are prefixed by combine_gtfs_feeds ("KCM_100045"); the prefix is used as the feed
+# key, and --feed-map (columns feed_onestop_id,prefix) maps TS feedOnestopId values onto those prefixes.
+# With --cache (the directory passed to wsdot.py --cache) each sample stop that disagrees is printed with its
+# hourly counts, marking the hours below the level's min_tph, and the first criterion the Python classifier failed.
+# The level columns compared, and the explanations of disagreements, come from the level definitions the Python run
+# used: --levels, or a manifest's levels column. A manifest runs every row (columns name,ts_report,python_csv and optionally cache,feed_map,levels) and
+# writes one summary table, so every agency feed can be checked in a batch.
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+import wsdot
+
+def level_columns(levels):
+    """The level columns wsdot.py writes for these level definitions, in its order"""
+    return wsdot.output_level_columns(config['level_column'] for config in levels.values())
+
+def read_ts_stops(filename, columns):
+    """Read WSDOTStopResult records from a report JSON or NDJSON file"""
+    records = []
+    with open(filename) as f:
+        if filename.endswith('.ndjson'):
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    records.extend(item['stops'] if 'stops' in item else [item])
+        else:
+            report = json.load(f)
+            records = report['stops'] if isinstance(report, dict) else report
+    frame = pd.DataFrame.from_records(records)
+    out = pd.DataFrame({'feed': frame['feedOnestopId'].astype(str), 'stop_id': frame['stopId'].astype(str)})
+    for level in columns:
+        out[level] = frame[level].fillna(False).astype(bool).to_numpy() if level in frame else False
+    return out
+
+def read_python_stops(filename, columns):
+    """Read wsdot.py output, splitting the combine_gtfs_feeds prefix into a feed column"""
+    frame = pd.read_csv(filename, dtype={'stop_id': str})
+    missing = [level for level in columns if level not in frame]
+    if missing:
+        raise ValueError(f"{filename} lacks the level columns {', '.join(missing)}; pass the --levels the wsdot.py run used")
+    parts = frame['stop_id'].str.partition('_')
+    prefixed = parts[1] == '_'
+    out = pd.DataFrame({
+        'feed': parts[0].where(prefixed, ''),
+        'stop_id': parts[2].where(prefixed, frame['stop_id']),
+        'python_stop_id': frame['stop_id'],
+    })
+    for level in columns:
+        out[level] = pd.to_numeric(frame[level], errors='coerce').fillna(0).to_numpy() > 0
+    return out
+
+def read_feed_map(filename):
+    """Read a feed_onestop_id -> prefix mapping"""
+    frame = pd.read_csv(filename, dtype=str)
+    return dict(zip(frame['feed_onestop_id'], frame['prefix']))
+
+def key_hashes(feed, stop_id):
+    """Hash (feed, stop_id) pairs into uint64 join keys"""
+    keys = feed.to_numpy(dtype=object) + '\x1f' + stop_id.to_numpy(dtype=object)
+    return pd.util.hash_array(keys.astype(object), categorize=False)
+
+def join_stops(ts, py):
+    """Outer join on (feed, stop_id) through a hashed index
+
+    Returns (ts_rows, py_rows) position arrays, -1 where the stop is missing
+    from that side.
+    """
+    ts_keys = key_hashes(ts['feed'], ts['stop_id'])
+    first = ~pd.Index(ts_keys).duplicated()
+    positions = np.flatnonzero(first)
+    rows = pd.Index(ts_keys[first]).get_indexer(key_hashes(py['feed'], py['stop_id']))
+    ts_rows = np.where(rows >= 0, positions[rows], -1)
+    matched = np.zeros(len(ts), dtype=bool)
+    matched[ts_rows[ts_rows >= 0]] = True
+    ts_only = np.flatnonzero(~matched & first)
+    return (
+        np.concatenate([ts_rows, ts_only]),
+        np.concatenate([np.arange(len(py)), np.full(len(ts_only), -1)]),
+    )
+
+def compare(ts, py, columns):
+    """Per-level agreement counts and the joined disagreement rows"""
+    ts_rows, py_rows = join_stops(ts, py)
+    both = (ts_rows >= 0) & (py_rows >= 0)
+    summary = []
+    joined = pd.DataFrame({
+        'feed': np.where(py_rows >= 0, py['feed'].to_numpy()[py_rows], ts['feed'].to_numpy()[ts_rows]),
+        'stop_id': np.where(py_rows >= 0, py['stop_id'].to_numpy()[py_rows], ts['stop_id'].to_numpy()[ts_rows]),
+        'python_stop_id': np.where(py_rows >= 0, py['python_stop_id'].to_numpy()[py_rows], ''),
+    })
+    for level in columns:
+        ts_level = np.where(ts_rows >= 0, ts[level].to_numpy()[ts_rows], False)
+        py_level = np.where(py_rows >= 0, py[level].to_numpy()[py_rows], False)
+        joined[f'{level}_ts'] = ts_level
+        joined[f'{level}_python'] = py_level
+        summary.append({
+            'level': level,
+            'both': int((ts_level & py_level).sum()),
+            'ts_only': int((ts_level & ~py_level).sum()),
+            'python_only': int((~ts_level & py_level).sum()),
+            'agreement': float((ts_level == py_level)[both].mean()) if both.any() else 1.0,
+        })
+    summary = pd.DataFrame(summary)
+    summary.attrs['ts_only_stops'] = int((py_rows < 0).sum())
+    summary.attrs['python_only_stops'] = int((ts_rows < 0).sum())
+    return summary, joined
+
+def describe_hours(matrices, stop, time_config):
+    """Format a stop's counts over a time window, starring hours below min_tph"""
+    counts = matrices.stop_tph[stop, wsdot.HourWindow.compile(time_config).hours]
+    return ' '.join(
+        f"{hour_column.split('_')[1]}:{count}{'*' if count < time_config['min_tph'] else ''}"
+        for hour_column, count in zip(time_config['hours'], counts)
+    )
+
+def print_samples(joined, level, levels, cache, evaluations, samples):
+    """Print sample stops that disagree on a level with their hourly counts"""
+    differs = joined[joined[f'{level}_ts'] != joined[f'{level}_python']]
+    if differs.empty:
+        return
+    name, config = next(((n, c) for n, c in levels.items() if c['level_column'] == level), (None, None))
+    print(f"\n{level}: {len(differs)} stops disagree")
+    if name is None:
+        cache = None
+    if cache:
+        weekday, weekend = cache
+        stop_index = pd.Index(weekday.stop_ids)
+        criteria, margins = evaluations[name]
+    for row in differs.head(samples).itertuples(index=False):
+        side = 'ts only' if getattr(row, f'{level}_ts') else 'python only'
+        print(f"  {row.feed} {row.stop_id} ({side})")
+        if not cache or not row.python_stop_id:
+            continue
+        stop = stop_index.get_indexer([row.python_stop_id])[0]
+        if stop < 0:
+            continue
+        failed = np.flatnonzero(margins[:, stop] < 0)
+        if len(failed):
+            print(f"    python fails {criteria[failed[0]]} by {-margins[failed[0], stop]}")
+        for period, matrices in (('peak', weekday), ('extended', weekday), ('weekend', weekend)):
+            if period in config:
+                print(f"    {period}: {describe_hours(matrices, stop, config[period])}")
+
+def run(ts_report, python_csv, cache_dir=None, feed_map=None, samples=10, levels=None):
+    """Compare one TS report against one wsdot.py output
+
+    levels are the definitions the Python run used (default SERVICE_LEVELS),
+    for explaining disagreements from the cache.
+    """
+    levels = levels or wsdot.SERVICE_LEVELS
+    columns = level_columns(levels)
+    ts = read_ts_stops(ts_report, columns)
+    if feed_map:
+        ts['feed'] = ts['feed'].map(read_feed_map(feed_map)).fillna(ts['feed'])
+    py = read_python_stops(python_csv, columns)
+    summary, joined = compare(ts, py, columns)
+    print(summary.to_string(index=False))
+    print(f"unmatched stops: {summary.attrs['ts_only_stops']} only in TS, {summary.attrs['python_only_stops']} only in python")
+
+    cache, evaluations = None, None
+    if cache_dir:
+        cache = wsdot.load_service_cache(cache_dir, mmap_mode='r')
+        evaluations = wsdot.classify_stops(levels, *cache)
+    for level in columns:
+        print_samples(joined, level, levels, cache, evaluations, samples)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare TS and Python WSDOT level assignments")
+    parser.add_argument('ts_report', nargs='?')
+    parser.add_argument('python_csv', nargs='?')
+    parser.add_argument('--cache', metavar='DIR', help="matrix cache written by wsdot.py --cache")
+    parser.add_argument('--feed-map', metavar='CSV', help="feed_onestop_id,prefix mapping")
+    parser.add_argument('--levels', metavar='PATH', default=wsdot.DEFAULT_LEVELS_PATH, help="level definitions the Python run used (default: the web tool's service-levels.json)")
+    parser.add_argument('--manifest', metavar='CSV', help="name,ts_report,python_csv[,cache,feed_map,levels] rows to run in batch")
+    parser.add_argument('--samples', type=int, default=10, help="disagreeing stops to print per level")
+    parser.add_argument('--summary', metavar='CSV', help="write the per-level summary table")
+    args = parser.parse_args()
+
+    if args.manifest:
+        runs = pd.read_csv(args.manifest, dtype=str).fillna('')
+    elif args.ts_report and args.python_csv:
+        runs = pd.DataFrame([{'name': '', 'ts_report': args.ts_report, 'python_csv': args.python_csv,
+                              'cache': args.cache or '', 'feed_map': args.feed_map or '', 'levels': ''}])
+    else:
+        parser.error("either ts_report and python_csv or --manifest is required")
+
+    # Every run's level definitions are read before any comparison starts
+    try:
+        run_levels = [wsdot.load_levels(run_row.get('levels') or args.levels) for run_row in runs.to_dict('records')]
+    except (OSError, ValueError) as e:
+        parser.error(f"levels: {e}")
+
+    summaries = []
+    for run_row, levels in zip(runs.to_dict('records'), run_levels):
+        print(f"\n== {run_row['name'] or run_row['python_csv']}")
+        summary = run(run_row['ts_report'], run_row['python_csv'], run_row.get('cache') or None,
+                      run_row.get('feed_map') or None, args.samples, levels)
+        summary.insert(0, 'name', run_row['name'])
+        summaries.append(summary)
+    if args.summary:
+        pd.concat(summaries).to_csv(args.summary, index=False)
+
+if __name__ == "__main__":
+    main()
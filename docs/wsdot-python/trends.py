@@ -0,0 +1,89 @@
+# Run the WSDOT classifier over archived feed collections (2022, 2024, ...) and report level trends across years.
+#
+# Usage:
+#   python trends.py <runs.csv> <levels_out.csv> <transitions_out.csv> [--cache DIR] [--workers N] [--levels PATH]
+#
+# runs.csv has one row per collection: year,weekday_dir,weekday_date,weekend_dir,weekend_date
+# (e.g. 2022,gtfs/monday-22,20220815,gtfs/sunday-22,20220821). Runs are classified in a process pool and each feed's
+# frequency matrices are cached under --cache, keyed by feed path, service date and the size and mtime of the feed
+# files they are built from (stop_times, trips, calendars, ...), so re-running a report only reloads GTFS for new or
+# changed feeds.
+# levels_out is long format (year,stop_id,level) with one row per level a stop qualifies for. transitions_out counts
+# stops by their best numbered level (level1 best, "none" when unclassified) in consecutive years.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import wsdot
+
+RANKED_LEVELS = ['level1', 'level2', 'level3', 'level4', 'level5', 'level6']
+
+def classify_run(run, cache_dir=None, levels=None):
+    """Classify one (year, weekday feed, weekend feed) run into year,stop_id,level rows"""
+    levels = levels or wsdot.SERVICE_LEVELS
+    n_hours = wsdot.max_config_hour(levels) + 1
+    weekday = wsdot.load_feed_matrices(run['weekday_dir'], str(run['weekday_date']), cache_dir, n_hours)
+    weekend = wsdot.load_feed_matrices(run['weekend_dir'], str(run['weekend_date']), cache_dir, n_hours)
+    weekend = wsdot.align_matrices(weekend, weekday.stop_ids)
+    frames = []
+    for name, (criteria, margins) in wsdot.classify_stops(levels, weekday, weekend).items():
+        stop_ids = weekday.stop_ids[wsdot.level_mask(margins)]
+        frames.append(pd.DataFrame({
+            'year': run['year'],
+            'stop_id': stop_ids,
+            'level': levels[name]['level_column'],
+        }))
+    print(f"{run['year']}: {len(weekday.stop_ids)} stops classified")
+    return pd.concat(frames, ignore_index=True)
+
+def best_levels(levels):
+    """Best ranked level per (year, stop_id)"""
+    ranked = levels[levels['level'].isin(RANKED_LEVELS)]
+    rank = pd.Categorical(ranked['level'], categories=RANKED_LEVELS, ordered=True).codes
+    best = pd.Series(rank, index=pd.MultiIndex.from_frame(ranked[['year', 'stop_id']])).groupby(level=[0, 1]).min()
+    return best.map(lambda code: RANKED_LEVELS[code])
+
+def level_transitions(levels):
+    """Count stops moving between best levels in consecutive years"""
+    best = best_levels(levels)
+    years = sorted(levels['year'].unique())
+    stops_by_year = {year: levels.loc[levels['year'] == year, 'stop_id'].unique() for year in years}
+    rows = []
+    for from_year, to_year in zip(years, years[1:]):
+        stop_ids = pd.Index(np.union1d(stops_by_year[from_year], stops_by_year[to_year]))
+        pairs = pd.DataFrame({
+            'from_level': best.get(from_year, pd.Series(dtype=object)).reindex(stop_ids).fillna('none').to_numpy(),
+            'to_level': best.get(to_year, pd.Series(dtype=object)).reindex(stop_ids).fillna('none').to_numpy(),
+        })
+        counts = pairs.groupby(['from_level', 'to_level']).size().rename('stops').reset_index()
+        counts.insert(0, 'to_year', to_year)
+        counts.insert(0, 'from_year', from_year)
+        rows.append(counts)
+    if not rows:
+        return pd.DataFrame(columns=['from_year', 'to_year', 'from_level', 'to_level', 'stops'])
+    return pd.concat(rows, ignore_index=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify stops over many years of archived feeds")
+    parser.add_argument('runs', help="CSV of year,weekday_dir,weekday_date,weekend_dir,weekend_date")
+    parser.add_argument('levels_out', help="long year,stop_id,level output")
+    parser.add_argument('transitions_out', help="level transition counts between consecutive years")
+    parser.add_argument('--cache', metavar='DIR', help="per-feed frequency matrix cache")
+    parser.add_argument('--workers', type=int, help="worker processes (default: CPU count)")
+    parser.add_argument('--levels', metavar='PATH', default=wsdot.DEFAULT_LEVELS_PATH, help="level definitions (default: the web tool's service-levels.json)")
+    args = parser.parse_args()
+    levels = wsdot.load_levels(args.levels)
+
+    runs = pd.read_csv(args.runs, dtype=str).to_dict('records')
+    with ProcessPoolExecutor(args.workers) as pool:
+        frames = list(pool.map(classify_run, runs, [args.cache] * len(runs), [levels] * len(runs)))
+    levels = pd.concat(frames, ignore_index=True).sort_values(['year', 'stop_id', 'level'], kind='stable')
+    levels.to_csv(args.levels_out, index=False)
+    level_transitions(levels).to_csv(args.transitions_out, index=False)
+    print(f"{len(runs)} runs written to {args.levels_out} and {args.transitions_out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# What-if service changes: add or remove route/direction trips per hour and see which stops change level, without
+# editing GTFS or rerunning wsdot.py.
+#
+# Usage:
+#   python whatif.py <cache_dir> <deltas.csv> [--levels PATH] [--out changes.csv]
+#
+# cache_dir is the directory written by wsdot.py --cache. deltas.csv has columns route_id, hour, trips and optionally
+# direction_id (blank for every direction of the route) and service (weekday or weekend, default weekday); trips is
+# the number of trips per hour to add (negative to remove). Each added trip departs every stop of the route/direction's
+# representative trip in the same hour, and is counted once in the route's hourly and total trips. Night segments use
+# the hour columns, as without --service-day-nights.
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import wsdot
+
+SERVICES = ('weekday', 'weekend')
+
+def _delta_rows(matrices, deltas):
+    """Match deltas to by_hour rows; returns (delta position, by_hour row) pairs"""
+    table = matrices.by_hour
+    route = pd.Index(matrices.route_ids).get_indexer(deltas['route_id'].astype(str))
+    if (route < 0).any():
+        unknown = deltas['route_id'][route < 0].unique().tolist()
+        raise ValueError(f"unknown route_id: {unknown[:10]}")
+    rows = pd.DataFrame({'route': table.route, 'direction': np.asarray(table.direction), 'row': np.arange(len(table.route))})
+    wanted = pd.DataFrame({'route': route, 'wanted': deltas['direction_id'].to_numpy(dtype=float), 'position': np.arange(len(deltas))})
+    matched = wanted.merge(rows, on='route')
+    matched = matched[matched['wanted'].isna() | (matched['wanted'] == matched['direction'])]
+    missing = np.setdiff1d(np.arange(len(deltas)), matched['position'])
+    if len(missing):
+        raise ValueError(f"no such route direction: {deltas.iloc[missing][['route_id', 'direction_id']].values.tolist()[:10]}")
+    return matched['position'].to_numpy(), matched['row'].to_numpy()
+
+def _add_clipped(counts, index, values):
+    counts = counts.astype(np.int64)
+    np.add.at(counts, index, values)
+    return np.maximum(counts, 0)
+
+def apply_route_deltas(matrices, deltas):
+    """Apply route/direction hourly trip deltas to copies of one service's matrices
+
+    deltas has route_id, direction_id (NaN for every direction), hour and
+    trips. Counts never go below zero. Returns (matrices, stop rows whose
+    level may change): every stop on a changed route_id, since the route
+    tests are merged on route_id.
+    """
+    by_hour, totals = matrices.by_hour, matrices.totals
+    if by_hour.stop_directions is None:
+        raise ValueError("matrices predate per-direction route stops; rebuild the cache with wsdot.py --cache")
+    hours = deltas['hour'].to_numpy(dtype=np.int64)
+    if len(hours) and (hours.min() < 0 or hours.max() >= matrices.n_hours):
+        raise ValueError(f"hours must be in 0..{matrices.n_hours - 1}")
+    trips = deltas['trips'].to_numpy(dtype=np.int64)
+    position, row = _delta_rows(matrices, deltas)
+    route, direction = by_hour.route[row], np.asarray(by_hour.direction)[row]
+    hours, trips = hours[position], trips[position]
+
+    counts = _add_clipped(by_hour.counts, (row, hours), trips).astype(by_hour.counts.dtype)
+
+    # Route totals, matched on (route, direction) since the two tables are grouped separately
+    total_keys = pd.MultiIndex.from_arrays([totals.route, np.asarray(totals.direction)])
+    total_row = total_keys.get_indexer(pd.MultiIndex.from_arrays([route, direction]))
+    present = total_row >= 0
+    total_counts = _add_clipped(totals.counts, (total_row[present], 0), trips[present]).astype(totals.counts.dtype)
+
+    # Departures at every stop of each changed route direction
+    served = pd.DataFrame({'route': by_hour.stop_routes, 'direction': by_hour.stop_directions, 'stop': by_hour.stop_stops})
+    changes = pd.DataFrame({'route': route, 'direction': direction, 'hour': hours, 'trips': trips})
+    departures = changes.merge(served, on=['route', 'direction'])
+    stop_tph = _add_clipped(matrices.stop_tph, (departures['stop'].to_numpy(), departures['hour'].to_numpy()),
+                            departures['trips'].to_numpy()).astype(matrices.stop_tph.dtype)
+    stop_served = np.array(matrices.stop_served, dtype=bool)
+    stop_served[departures['stop'].to_numpy()[stop_tph[departures['stop'], departures['hour']] > 0]] = True
+
+    changed = np.unique(route)
+    affected = np.unique(np.concatenate([
+        by_hour.stop_stops[np.isin(by_hour.stop_routes, changed)],
+        totals.stop_stops[np.isin(totals.stop_routes, changed)],
+    ]))
+    scenario = wsdot.ServiceMatrices(
+        matrices.stop_ids, stop_tph, stop_served, matrices.route_ids,
+        wsdot.RouteTable(by_hour.route, by_hour.direction, counts, by_hour.stop_routes, by_hour.stop_stops, by_hour.stop_directions),
+        wsdot.RouteTable(totals.route, totals.direction, total_counts, totals.stop_routes, totals.stop_stops, totals.stop_directions),
+    )
+    return scenario, affected
+
+def take_stops(matrices, rows):
+    """Restrict the stop axis to rows, keeping every route"""
+    remap = np.full(len(matrices.stop_ids), -1, dtype=np.int64)
+    remap[rows] = np.arange(len(rows))
+
+    def take_table(table):
+        stops = remap[table.stop_stops]
+        keep = stops >= 0
+        directions = None if table.stop_directions is None else table.stop_directions[keep]
+        return wsdot.RouteTable(table.route, table.direction, table.counts, table.stop_routes[keep], stops[keep], directions)
+
+    return wsdot.ServiceMatrices(
+        np.asarray(matrices.stop_ids)[rows], np.asarray(matrices.stop_tph)[rows], np.asarray(matrices.stop_served)[rows],
+        matrices.route_ids, take_table(matrices.by_hour), take_table(matrices.totals),
+    )
+
+class WhatIf:
+    """Baseline classification that scenarios are re-evaluated against
+
+    The baseline level masks and stop-level masks are computed once; apply
+    then evaluates only the stops on changed routes. The one exception is the
+    legacy fallback (stop-level tests are dropped when no stop passes them):
+    when a scenario flips it for a level, that level is re-evaluated in full.
+    """
+    def __init__(self, levels, weekday, weekend):
+        self.levels = wsdot.compile_levels(levels)
+        self.weekday = weekday
+        self.weekend = weekend
+        evaluations = wsdot.classify_stops(self.levels, weekday, weekend)
+        self.masks = {name: wsdot.level_mask(margins) for name, (criteria, margins) in evaluations.items()}
+        self.stop_level = {name: wsdot.stop_level_mask(level, weekday) for name, level in self.levels.items()}
+
+    def apply(self, deltas):
+        """Level changes of a scenario as stop_id, level, before, after rows"""
+        deltas = pd.DataFrame(deltas).copy()
+        if 'direction_id' not in deltas:
+            deltas['direction_id'] = np.nan
+        if 'service' not in deltas:
+            deltas['service'] = 'weekday'
+        unknown = set(deltas['service']) - set(SERVICES)
+        if unknown:
+            raise ValueError(f"unknown service: {sorted(unknown)}")
+
+        scenario = {'weekday': self.weekday, 'weekend': self.weekend}
+        affected = [np.zeros(0, dtype=np.int64)]
+        for service, service_deltas in deltas.groupby('service'):
+            scenario[service], rows = apply_route_deltas(scenario[service], service_deltas)
+            affected.append(rows)
+        rows = np.unique(np.concatenate(affected))
+        weekday, weekend = take_stops(scenario['weekday'], rows), take_stops(scenario['weekend'], rows)
+
+        outside = np.ones(len(self.weekday.stop_ids), dtype=bool)
+        outside[rows] = False
+        changes = []
+        for name, level in self.levels.items():
+            elsewhere = bool((self.stop_level[name] & outside).any())
+            passes = elsewhere or wsdot.stop_level_mask(level, weekday).any()
+            if passes != self.stop_level[name].any():
+                # The fallback flipped, which changes every stop's criteria
+                stops = np.arange(len(self.weekday.stop_ids))
+                after = wsdot.level_mask(wsdot.evaluate_level(level, scenario['weekday'], scenario['weekend'])[1])
+            else:
+                stops = rows
+                after = wsdot.level_mask(wsdot.evaluate_level(level, weekday, weekend, stop_passes_elsewhere=elsewhere)[1])
+            before = self.masks[name][stops]
+            moved = np.flatnonzero(before != after)
+            changes.append(pd.DataFrame({
+                'stop_id': np.asarray(self.weekday.stop_ids)[stops[moved]],
+                'level': level.level_column,
+                'before': before[moved],
+                'after': after[moved],
+            }))
+        return pd.concat(changes, ignore_index=True)
+
+def read_deltas(filename):
+    """Read a deltas CSV (route_id, hour, trips[, direction_id, service])"""
+    deltas = pd.read_csv(filename, dtype={'route_id': str, 'service': str})
+    if 'direction_id' in deltas:
+        deltas['direction_id'] = pd.to_numeric(deltas['direction_id'], errors='coerce')
+    return deltas
+
+def main():
+    parser = argparse.ArgumentParser(description="Level changes from route/direction trip changes, using wsdot.py --cache matrices")
+    parser.add_argument('cache', help="matrix cache written by wsdot.py --cache")
+    parser.add_argument('deltas', help="route_id,hour,trips[,direction_id,service] CSV")
+    parser.add_argument('--levels', metavar='PATH', default=wsdot.DEFAULT_LEVELS_PATH, help="level definitions (default: the web tool's service-levels.json)")
+    parser.add_argument('--out', metavar='PATH', help="write the stop_id,level,before,after changes (.csv or .parquet)")
+    args = parser.parse_args()
+
+    weekday, weekend = wsdot.load_service_cache(args.cache)
+    engine = WhatIf(wsdot.load_levels(args.levels), weekday, weekend)
+    deltas = read_deltas(args.deltas)
+    start = time.perf_counter()
+    changes = engine.apply(deltas)
+    elapsed = time.perf_counter() - start
+    gained = changes[changes['after']].groupby('level').size()
+    lost = changes[~changes['after']].groupby('level').size()
+    summary = pd.DataFrame({'gained': gained, 'lost': lost}).fillna(0).astype(int)
+    print(summary.to_string() if not summary.empty else "no level changes")
+    print(f"{len(deltas)} deltas evaluated in {elapsed * 1000:.1f} ms")
+    if args.out:
+        wsdot.write_table(changes, args.out)
+
+if __name__ == "__main__":
+    main()
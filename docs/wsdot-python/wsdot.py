@@ -10,70 +10,77 @@
 import pandas as pd
 import numpy as np
 import transit_service_analyst as tsa
+import argparse
+import collections
+import csv
+import hashlib
+import json
+import math
+import os
+import shutil
+import struct
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-# Configuration for all service levels
-SERVICE_LEVELS = {
-    'night': {
-        'peak': {'hours': ['hour_5', 'hour_6', 'hour_7', 'hour_8', 'hour_9', 'hour_10', 'hour_11', 'hour_12', 'hour_13', 'hour_14', 'hour_15', 'hour_16', 'hour_17', 'hour_18', 'hour_19', 'hour_20', 'hour_21', 'hour_22', 'hour_23', 'hour_24', 'hour_25', 'hour_26', 'hour_27', 'hour_28'], 'min_tph': 0, 'min_total': 4},
-        'night_segments': [
-            {'hours': ['hour_23', 'hour_24'], 'min_total': 1},
-            {'hours': ['hour_25', 'hour_26'], 'min_total': 1},
-            {'hours': ['hour_27', 'hour_28'], 'min_total': 1},
-            {'hours': ['hour_26', 'hour_27'], 'min_total': 1}
-        ],
-        'weekend_required': True,
-        'level_column': 'levelNights'
-    },
-    'level1': {
-        'peak': {'hours': ['hour_10', 'hour_11', 'hour_12', 'hour_13', 'hour_14', 'hour_15', 'hour_16', 'hour_9'], 'min_tph': 4, 'min_total': 40},
-        'extended': {'hours': ['hour_6', 'hour_7', 'hour_8', 'hour_17', 'hour_18', 'hour_19', 'hour_20', 'hour_21'], 'min_tph': 3, 'min_total': 32},
-        'weekend': {'hours': ['hour_10', 'hour_11', 'hour_12', 'hour_13', 'hour_14', 'hour_15', 'hour_16', 'hour_9'], 'min_tph': 3, 'min_total': 32},
-        'night_segments': [
-            {'hours': ['hour_23', 'hour_24'], 'min_total': 0},
-            {'hours': ['hour_25', 'hour_26'], 'min_total': 0},
-            {'hours': ['hour_27', 'hour_28'], 'min_total': 0},
-            {'hours': ['hour_26', 'hour_27'], 'min_total': 0}
-        ],
-        'weekend_required': True,
-        'level_column': 'level1'
-    },
-    'level2': {
-        'peak': {'hours': ['hour_10', 'hour_11', 'hour_12', 'hour_13', 'hour_14', 'hour_15', 'hour_16', 'hour_9'], 'min_tph': 3, 'min_total': 32},
-        'extended': {'hours': ['hour_6', 'hour_7', 'hour_8', 'hour_17', 'hour_18', 'hour_19', 'hour_20', 'hour_21'], 'min_tph': 1, 'min_total': 16},
-        'weekend': {'hours': ['hour_10', 'hour_11', 'hour_12', 'hour_13', 'hour_14', 'hour_15', 'hour_16', 'hour_9'], 'min_tph': 1, 'min_total': 16},
-        'weekend_required': True,
-        'level_column': 'level2'
-    },
-    'level3': {
-        'peak': {'hours': ['hour_10', 'hour_11', 'hour_12', 'hour_13', 'hour_14', 'hour_15', 'hour_16', 'hour_9'], 'min_tph': 1, 'min_total': 16},
-        'extended': {'hours': ['hour_6', 'hour_7', 'hour_8', 'hour_17', 'hour_18', 'hour_19', 'hour_20', 'hour_21'], 'min_tph': 0, 'min_total': 8},
-        'weekend': {'hours': ['hour_10', 'hour_11', 'hour_12', 'hour_13', 'hour_14', 'hour_15', 'hour_16', 'hour_9'], 'min_tph': 0, 'min_total': 8},
-        'weekend_required': True,
-        'level_column': 'level3'
-    },
-    'level4': {
-        'peak': {'hours': ['hour_10', 'hour_11', 'hour_12', 'hour_13', 'hour_14', 'hour_15', 'hour_16', 'hour_9'], 'min_tph': 0, 'min_total': 8},
-        'weekend_required': False,
-        'level_column': 'level4'
-    },
-    'level5': {
-        'total_trips_threshold': 6,
-        'weekend_required': False,
-        'level_column': 'level5'
-    },
-    'level6': {
-        'total_trips_threshold': 2,
-        'weekend_required': False,
-        'level_column': 'level6'
-    },
-    'levelAll': {
-        'total_trips_threshold': 0,
-        'weekend_required': False,
-        'level_column': 'levelAll'
-    }
+# Service level definitions are shared with the web tool (src/analysis/wsdot/service-levels.ts), keyed by output
+# column. Hours are service-day hours, so 24-28 are the hours after midnight; --levels runs a study's own file.
+DEFAULT_LEVELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src', 'analysis', 'wsdot', 'service-levels.json')
+
+def _hour_window(window):
+    return dict(window, hours=[f'hour_{hour}' for hour in window['hours']])
+
+def load_levels(filename=DEFAULT_LEVELS_PATH):
+    """Read level definitions (JSON, or YAML when PyYAML is installed) into the SERVICE_LEVELS shape"""
+    with open(filename) as f:
+        if filename.endswith(('.yaml', '.yml')):
+            import yaml
+            document = yaml.safe_load(f)
+        else:
+            document = json.load(f)
+    return parse_levels(document)
+
+LEVEL_TESTS = ('peak', 'extended', 'weekend', 'night_segments', 'total_trips_threshold')
 
-}
+def _check_window(column, name, window):
+    if not isinstance(window, dict) or 'hours' not in window or 'min_total' not in window:
+        raise ValueError(f"level {column}: {name} needs hours and min_total")
+    if not all(isinstance(hour, int) and hour >= 0 for hour in window['hours']):
+        raise ValueError(f"level {column}: {name} hours must be non-negative integers")
+
+def parse_levels(document):
+    """Convert a levels document ({'levels': {column: definition}}, or just the mapping) into the SERVICE_LEVELS shape
+
+    Raises ValueError for a document that defines no levels or a level with
+    no test or a malformed hour window.
+    """
+    mapping = document.get('levels', document) if isinstance(document, dict) else None
+    if not mapping or not isinstance(mapping, dict):
+        raise ValueError("no levels defined")
+    levels = {}
+    for column, definition in mapping.items():
+        if not isinstance(definition, dict) or not any(test in definition for test in LEVEL_TESTS):
+            raise ValueError(f"level {column} defines none of {', '.join(LEVEL_TESTS)}")
+        for period in ('peak', 'extended', 'weekend'):
+            if period in definition:
+                _check_window(column, period, definition[period])
+        for i, segment in enumerate(definition.get('night_segments', [])):
+            _check_window(column, f'night_segments[{i}]', segment)
+        config = {}
+        for period in ('peak', 'extended', 'weekend'):
+            if period in definition:
+                config[period] = _hour_window(definition[period])
+        if 'night_segments' in definition:
+            config['night_segments'] = [_hour_window(segment) for segment in definition['night_segments']]
+        if 'total_trips_threshold' in definition:
+            config['total_trips_threshold'] = definition['total_trips_threshold']
+        config['weekend_required'] = definition.get('weekend_required', False)
+        config['level_column'] = column
+        levels[column] = config
+    return levels
+
+# Configuration for all service levels
+SERVICE_LEVELS = load_levels()
 
 def process_night_segments(service, night_segments):
     """Process night service segments and merge results"""
@@ -246,56 +253,1363 @@ def process_service_level(level_name, config, weekday_service, weekend_service):
     
     return result
 
+# Vectorized classification
+#
+# The functions above re-query the tsa accessors and re-filter the same frames
+# for every level and period. The matrices below are built once per service
+# and every level, criterion and explanation is evaluated against them.
+
+def hour_index(column):
+    """Return the integer hour of an 'hour_N' column name"""
+    return int(column.split('_')[1])
+
+class HourWindow:
+    """A time window compiled to integer hour indexes and its thresholds"""
+    def __init__(self, hours, min_tph, min_total):
+        self.hours = hours
+        self.min_tph = min_tph
+        self.min_total = min_total
+
+    @classmethod
+    def compile(cls, time_config):
+        hours = np.array([hour_index(h) for h in time_config['hours']], dtype=np.intp)
+        return cls(hours, time_config.get('min_tph', 0), time_config['min_total'])
+
+class CompiledLevel:
+    """A SERVICE_LEVELS entry with every 'hour_N' resolved once, up front"""
+    def __init__(self, config):
+        self.level_column = config['level_column']
+        self.total_trips_threshold = config.get('total_trips_threshold')
+        self.periods = {period: HourWindow.compile(config[period]) for period in ('peak', 'extended', 'weekend') if period in config}
+        self.night_segments = [HourWindow.compile(segment) for segment in config.get('night_segments', [])]
+        self.weekend_required = config.get('weekend_required', False)
+
+    @property
+    def route_window(self):
+        return self.periods.get('peak', self.periods.get('extended'))
+
+def compile_levels(levels):
+    """Compile {level_name: config} to {level_name: CompiledLevel}; compiled entries pass through"""
+    return {name: config if isinstance(config, CompiledLevel) else CompiledLevel(config) for name, config in levels.items()}
+
+def max_config_hour(levels):
+    """Return the largest hour referenced by any service level"""
+    hours = [0]
+    for level in compile_levels(levels).values():
+        for window in list(level.periods.values()) + level.night_segments:
+            hours.extend(window.hours.tolist())
+    return max(hours)
+
+def _hour_columns(frame):
+    return [c for c in frame.columns if isinstance(c, str) and c.startswith('hour_')]
+
+class WindowReductions:
+    """Row-wise min and sum of a count matrix over each distinct hour window
+
+    Levels share windows (levels 1-4 all test the same peak hours), so each
+    window is reduced once and every level only subtracts its thresholds.
+    """
+    def __init__(self, counts):
+        self.counts = counts
+        self._reduced = {}
+
+    def __call__(self, window):
+        key = window.hours.tobytes()
+        if key not in self._reduced:
+            counts = self.counts[:, window.hours]
+            self._reduced[key] = (counts.min(axis=1), counts.sum(axis=1))
+        return self._reduced[key]
+
+class RouteTable:
+    """Route/direction aggregates from one of the tsa line accessors
+
+    counts is a (route/direction x value) matrix and route maps each row to an
+    index into the service's route_ids. stop_routes/stop_stops are the
+    (route, stop) index pairs reached through the representative trips of each
+    route_id, which is how analyze_route_frequency expands qualifying routes
+    into stops (the merge is on route_id alone, so both directions count).
+    stop_directions holds the direction of the representative trip behind each
+    pair, so a stop served in both directions appears twice.
+    """
+    def __init__(self, route, direction, counts, stop_routes, stop_stops, stop_directions=None):
+        self.route = route
+        self.direction = direction
+        self.counts = counts
+        self.stop_routes = stop_routes
+        self.stop_stops = stop_stops
+        self.stop_directions = stop_directions
+        self.window = WindowReductions(counts)
+
+    @classmethod
+    def build(cls, frame, value_columns, n_values, route_index, stop_index, line_stops, rep_trips=None):
+        """Aggregate frame the way pivot_table does in analyze_route_frequency
+
+        rep_trips (route_id, rep_trip_id) defaults to the pairs in frame.
+        """
+        frame = frame.dropna(subset=['route_id'])
+        grouped = frame.groupby(['route_id', 'direction_id'])[value_columns].sum()
+        counts = np.zeros((len(grouped), n_values), dtype=np.int32)
+        if value_columns == ['total_trips']:
+            counts[:, 0] = grouped['total_trips'].fillna(0).to_numpy()
+        else:
+            for column in value_columns:
+                counts[:, hour_index(column)] = grouped[column].fillna(0).to_numpy()
+        route = route_index.get_indexer(grouped.index.get_level_values('route_id'))
+        direction = grouped.index.get_level_values('direction_id').to_numpy()
+
+        pairs = (frame if rep_trips is None else rep_trips)[['route_id', 'direction_id', 'rep_trip_id']].drop_duplicates()
+        pairs = pairs.merge(line_stops, left_on='rep_trip_id', right_on='trip_id')
+        pairs = pairs[['route_id', 'direction_id', 'stop_id']].drop_duplicates()
+        stop_routes = route_index.get_indexer(pairs['route_id'])
+        stop_stops = stop_index.get_indexer(pairs['stop_id'])
+        stop_directions = pairs['direction_id'].fillna(-1).to_numpy().astype(np.int16)
+        keep = stop_stops >= 0
+        return cls(route, direction, counts, stop_routes[keep], stop_stops[keep], stop_directions[keep])
+
+class ServiceMatrices:
+    """Stop x hour and route x hour count matrices for one service day
+
+    stop_tph[i, h] is the number of departures at stop_ids[i] in hour h, and
+    stop_served marks the stops present in get_tph_at_stops (the legacy stop
+    filters never see the others). by_hour and totals hold the
+    get_tph_by_line and get_total_trips_by_line aggregates.
+    """
+    def __init__(self, stop_ids, stop_tph, stop_served, route_ids, by_hour, totals):
+        self.stop_ids = stop_ids
+        self.stop_tph = stop_tph
+        self.stop_served = stop_served
+        self.route_ids = route_ids
+        self.by_hour = by_hour
+        self.totals = totals
+        self.stop_window = WindowReductions(stop_tph)
+
+    @property
+    def n_hours(self):
+        return self.stop_tph.shape[1]
+
+def _scan_tph(scan):
+    """Reshape FeedScan.stop_hours into the get_tph_at_stops layout"""
+    tph = scan.stop_hours.pivot(index='stop_id', columns='hour', values='departures')
+    tph.columns = [f'hour_{hour}' for hour in tph.columns]
+    return tph.reset_index()
+
+def service_stop_hours(service):
+    """get_tph_at_stops as one grouped count of tsa's stop_times frame instead of a pivot_table
+
+    That frame has frequencies.txt trips expanded, IDs as tsa reads them and
+    untimed stops interpolated, so the counts are get_tph_at_stops' own.
+    """
+    counts = service._df_all_stops_by_trips.groupby(['stop_id', 'departure_time_hrs']).size().unstack(fill_value=0)
+    counts.columns = [f'hour_{hour}' for hour in counts.columns]
+    return counts.reset_index()
+
+def service_departures(service):
+    """(stop_id, minute) arrays of every departure in tsa's stop_times frame, for build_timeline"""
+    stop_times = service._df_all_stops_by_trips
+    return stop_times['stop_id'].to_numpy(dtype=object), np.floor(stop_times['departure_time_mins'].to_numpy()).astype(np.int64)
+
+def service_route_hours(service):
+    """get_tph_by_line without its sort of all of stop_times
+
+    tsa renumbers each trip's stop_sequence to 1..n on load, so the rows
+    get_tph_by_line keeps after sorting and grouping are exactly the
+    stop_sequence == 1 rows of its stop_times frame (frequencies.txt trips
+    already expanded). Those are counted per rep_trip_id and hour, with the
+    rep trip's route_id and direction_id, as get_tph_by_line returns them.
+    """
+    stop_times = service._df_all_stops_by_trips
+    firsts = stop_times[stop_times['stop_sequence'] == 1]
+    counts = firsts.groupby(['rep_trip_id', 'departure_time_hrs']).size().unstack(fill_value=0)
+    counts.columns = [f'hour_{hour}' for hour in counts.columns]
+    counts = counts.reset_index().merge(service.trips[['route_id', 'trip_id', 'direction_id']], how='left',
+                                        left_on='rep_trip_id', right_on='trip_id')
+    return counts.drop(columns=['trip_id'])
+
+def route_hour_counts(trip_index, patterns=None):
+    """Trips per route/direction by the hour of their first departure, from a FeedScan trip index
+
+    The first departure is the row with the lowest stop_sequence, found with a
+    grouped argmin; it is the row get_tph_by_line counts. With patterns (a
+    spilled scan's, whose trips carry rep_trip_id), trips count under their
+    rep trip's route_id and direction_id, as get_tph_by_line groups them. The
+    scan reads stop_times.txt as written, so trips that only exist through
+    frequencies.txt are not counted.
+    """
+    trips = trip_index[trip_index['first_departure'] >= 0]
+    if patterns is not None:
+        trips = trips[['rep_trip_id', 'first_departure']].merge(patterns[['rep_trip_id', 'route_id', 'direction_id']], on='rep_trip_id')
+    trips = trips.dropna(subset=['route_id', 'direction_id'])
+    counts = trips.groupby(['route_id', 'direction_id', trips['first_departure'] // 60]).size()
+    counts = counts.unstack(fill_value=0)
+    counts.columns = [f'hour_{hour}' for hour in counts.columns]
+    return counts.reset_index()
+
+def build_service_matrices(service, stop_ids=None, n_hours=None):
+    """Aggregate a tsa service into ServiceMatrices
+
+    stop_ids fixes the stop axis (e.g. to align a weekend service onto the
+    weekday stops); by default it is every stop known to the service. Stop
+    and route hours are counted from the stop_times tsa already loaded
+    (service_stop_hours, service_route_hours).
+    """
+    tph = service_stop_hours(service)
+    totals = service.get_total_trips_by_line()
+    by_line = service_route_hours(service)
+    line_stops = service.get_line_stops_gdf()[['trip_id', 'stop_id']]
+    return _assemble_matrices(service.stops['stop_id'], tph, by_line, totals, None, line_stops, stop_ids, n_hours)
+
+def build_scan_matrices(scan, stop_ids=None, n_hours=None):
+    """Aggregate a spilled FeedScan into ServiceMatrices without a tsa service
+
+    The scan's stops, representative trips and trip totals stand in for
+    service.stops, get_line_stops_gdf and get_total_trips_by_line, so the
+    result matches build_service_matrices(service) on feeds without
+    frequencies.txt (the scan does not expand it) whose trips start and end on
+    timed stops, as GTFS requires (see interpolate_trip_minutes).
+    """
+    tph = _scan_tph(scan)
+    by_line = route_hour_counts(scan.trips, scan.patterns)
+    return _assemble_matrices(scan.stops['stop_id'], tph, by_line, scan.patterns, scan.patterns, scan.line_stops, stop_ids, n_hours)
+
+def _assemble_matrices(service_stop_ids, tph, by_line, totals, rep_trips, line_stops, stop_ids, n_hours):
+    if stop_ids is None:
+        stop_ids = pd.unique(pd.concat([service_stop_ids, tph['stop_id'], line_stops['stop_id']]))
+    stop_index = pd.Index(stop_ids)
+    # Sorted, so the route axis does not depend on the row order of the tsa accessors or the scan
+    route_index = pd.Index(pd.unique(pd.concat([by_line['route_id'], totals['route_id']]).dropna())).sort_values()
+
+    tph_columns = _hour_columns(tph)
+    line_columns = _hour_columns(by_line)
+    data_hours = [hour_index(c) + 1 for c in tph_columns + line_columns]
+    n_hours = max(data_hours + [n_hours or 0])
+
+    codes = stop_index.get_indexer(tph['stop_id'])
+    keep = codes >= 0
+    stop_tph = np.zeros((len(stop_index), n_hours), dtype=np.int32)
+    for column in tph_columns:
+        stop_tph[codes[keep], hour_index(column)] = tph[column].fillna(0).to_numpy()[keep]
+    stop_served = np.zeros(len(stop_index), dtype=bool)
+    stop_served[codes[keep]] = True
+
+    return ServiceMatrices(
+        stop_index.to_numpy(),
+        stop_tph,
+        stop_served,
+        route_index.to_numpy(),
+        RouteTable.build(by_line, line_columns, n_hours, route_index, stop_index, line_stops, rep_trips),
+        RouteTable.build(totals, ['total_trips'], 1, route_index, stop_index, line_stops),
+    )
+
+def _matrix_arrays(matrices):
+    arrays = {
+        'stop_ids': np.asarray(matrices.stop_ids, dtype=str),
+        'stop_tph': matrices.stop_tph,
+        'stop_served': matrices.stop_served,
+        'route_ids': np.asarray(matrices.route_ids, dtype=str),
+    }
+    for prefix, table in (('by_hour', matrices.by_hour), ('totals', matrices.totals)):
+        arrays[f'{prefix}_route'] = table.route
+        arrays[f'{prefix}_direction'] = np.asarray(table.direction, dtype=np.int16)
+        arrays[f'{prefix}_counts'] = table.counts
+        arrays[f'{prefix}_stop_routes'] = table.stop_routes
+        arrays[f'{prefix}_stop_stops'] = table.stop_stops
+        if table.stop_directions is not None:
+            arrays[f'{prefix}_stop_directions'] = table.stop_directions
+    return arrays
+
+def save_matrices(matrices, directory):
+    """Cache matrices in directory as one .npy file per array"""
+    os.makedirs(directory, exist_ok=True)
+    for name, array in _matrix_arrays(matrices).items():
+        np.save(os.path.join(directory, f'{name}.npy'), array)
+
+def load_matrices(directory, mmap_mode=None):
+    """Load matrices cached by save_matrices"""
+    def load(name):
+        filename = os.path.join(directory, f'{name}.npy')
+        # stop_directions is absent from caches written before it was tracked
+        if name.endswith('stop_directions') and not os.path.exists(filename):
+            return None
+        return np.load(filename, mmap_mode=mmap_mode)
+    tables = [
+        RouteTable(*(load(f'{prefix}_{name}') for name in ('route', 'direction', 'counts', 'stop_routes', 'stop_stops', 'stop_directions')))
+        for prefix in ('by_hour', 'totals')
+    ]
+    return ServiceMatrices(load('stop_ids'), load('stop_tph'), load('stop_served'), load('route_ids'), *tables)
+
+def save_service_cache(directory, weekday, weekend):
+    """Cache the weekday and weekend matrices under directory"""
+    save_matrices(weekday, os.path.join(directory, 'weekday'))
+    save_matrices(weekend, os.path.join(directory, 'weekend'))
+
+def load_service_cache(directory, mmap_mode=None):
+    """Load the (weekday, weekend) matrices cached by save_service_cache"""
+    return (
+        load_matrices(os.path.join(directory, 'weekday'), mmap_mode=mmap_mode),
+        load_matrices(os.path.join(directory, 'weekend'), mmap_mode=mmap_mode),
+    )
+
+def align_matrices(matrices, stop_ids):
+    """Reindex matrices onto another stop axis, e.g. a weekend service onto the weekday stops"""
+    codes = pd.Index(matrices.stop_ids).get_indexer(stop_ids)
+    present = codes >= 0
+    stop_tph = np.zeros((len(stop_ids), matrices.n_hours), dtype=matrices.stop_tph.dtype)
+    stop_tph[present] = matrices.stop_tph[codes[present]]
+    stop_served = np.zeros(len(stop_ids), dtype=bool)
+    stop_served[present] = matrices.stop_served[codes[present]]
+    remap = np.full(len(matrices.stop_ids), -1, dtype=np.int64)
+    remap[codes[present]] = np.flatnonzero(present)
+
+    def align_table(table):
+        stops = remap[table.stop_stops]
+        keep = stops >= 0
+        directions = None if table.stop_directions is None else table.stop_directions[keep]
+        return RouteTable(table.route, table.direction, table.counts, table.stop_routes[keep], stops[keep], directions)
+
+    return ServiceMatrices(np.asarray(stop_ids), stop_tph, stop_served, matrices.route_ids,
+                           align_table(matrices.by_hour), align_table(matrices.totals))
+
+# Feed files the cached matrices are built from: the calendar files pick the active trips, the rest hold them
+FEED_CACHE_FILES = ['stop_times.txt', 'trips.txt', 'calendar.txt', 'calendar_dates.txt', 'frequencies.txt', 'stops.txt', 'routes.txt']
+
+def feed_cache_key(gtfs_dir, service_date):
+    """Cache key for one feed on one service date, invalidated when any of FEED_CACHE_FILES changes"""
+    ident = [os.path.abspath(gtfs_dir), str(service_date)]
+    for filename in FEED_CACHE_FILES:
+        path = os.path.join(gtfs_dir, filename)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            ident.append(f'{filename}:{stat.st_size}:{stat.st_mtime_ns}')
+        else:
+            ident.append(f'{filename}:-')
+    return hashlib.sha1('|'.join(ident).encode()).hexdigest()[:16]
+
+def load_feed_matrices(gtfs_dir, service_date, cache_dir=None, n_hours=None):
+    """Build the matrices of one feed, reusing a per-feed cache under cache_dir when present"""
+    directory = cache_dir and os.path.join(cache_dir, feed_cache_key(gtfs_dir, service_date))
+    if directory and os.path.exists(os.path.join(directory, 'stop_tph.npy')):
+        matrices = load_matrices(directory)
+        if n_hours is None or matrices.n_hours >= n_hours:
+            return matrices
+    matrices = build_service_matrices(tsa.load_gtfs(gtfs_dir, service_date), n_hours=n_hours)
+    if directory:
+        # Write aside and rename so concurrent workers never read a partial cache
+        staging = f'{directory}.{os.getpid()}'
+        save_matrices(matrices, staging)
+        try:
+            os.replace(staging, directory)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+    return matrices
+
+def _stop_window_margins(matrices, window):
+    """Per-stop margins for the min_tph and min_total tests of a time window"""
+    min_count, total = matrices.stop_window(window)
+    return min_count - window.min_tph, total - window.min_total
+
+def _route_stop_margin(matrices, table, row_margin):
+    """Best route/direction margin over the routes serving each stop
+
+    A route_id qualifies when any of its directions does, and a stop qualifies
+    when any route reaching it does, so both reductions are a max. Stops no
+    route reaches get -1.
+    """
+    unset = np.iinfo(np.int64).min
+    route_margin = np.full(len(matrices.route_ids), unset, dtype=np.int64)
+    np.maximum.at(route_margin, table.route, row_margin)
+    stop_margin = np.full(len(matrices.stop_ids), unset, dtype=np.int64)
+    np.maximum.at(stop_margin, table.stop_stops, route_margin[table.stop_routes])
+    stop_margin[stop_margin == unset] = -1
+    return stop_margin
+
+def _route_row_margin(table, window):
+    """Per route/direction margin of the min_tph and min_total tests of a time window"""
+    min_count, total = table.window(window)
+    return np.minimum(min_count - window.min_tph, total - window.min_total)
+
+def _route_window_margin(matrices, window):
+    return _route_stop_margin(matrices, matrices.by_hour, _route_row_margin(matrices.by_hour, window))
+
+def _served_margin(matrices):
+    return np.where(matrices.stop_served, 0, -1)
+
+# Feed scan
+#
+# One chunked pass over stop_times.txt aggregates departures per stop and
+# hour, indexes each trip's first departure, and counts the feed problems that
+# otherwise only show up as wrong levels (the KCM errata above was found by
+# hand). Stops without a departure_time (GTFS only requires timepoints) get
+# times interpolated within their trip, as tsa.load_gtfs does.
+
+SCAN_CHUNK_SIZE = 1_000_000
+
+def gtfs_minutes(times):
+    """Convert GTFS 'H:MM:SS' strings (hours may exceed 24) to service-day minutes, NaN where missing or malformed"""
+    parts = times.str.extract(r'^\s*(\d+):([0-5]\d):([0-5]\d)\s*$').apply(pd.to_numeric)
+    return (parts[0] * 60 + parts[1] + parts[2] / 60).to_numpy(dtype=np.float64)
+
+def interpolate_trip_minutes(trip_id, minutes):
+    """Fill NaN minutes linearly between the timed stops around them in the same trip
+
+    Rows are one trip after another, each in stop_sequence order. As in
+    tsa, the fill is linear in row position. Untimed stops after a trip's
+    last timed stop take that stop's time (tsa interpolates them toward the
+    next trip's first stop) and stops before its first timed stop stay NaN.
+    """
+    n = len(minutes)
+    if not n:
+        return minutes
+    position = np.arange(n)
+    boundary = trip_id[1:] != trip_id[:-1]
+    trip_start = np.maximum.accumulate(np.where(np.r_[True, boundary], position, 0))
+    trip_end = np.minimum.accumulate(np.where(np.r_[boundary, True], position, n)[::-1])[::-1]
+    timed = ~np.isnan(minutes)
+    before = np.maximum.accumulate(np.where(timed, position, -1))
+    after = np.minimum.accumulate(np.where(timed, position, n)[::-1])[::-1]
+    has_before = ~timed & (before >= trip_start)
+    has_after = after <= trip_end
+
+    filled = minutes.copy()
+    between = has_before & has_after
+    start, end = before[between], after[between]
+    filled[between] = minutes[start] + (minutes[end] - minutes[start]) * (position[between] - start) / (end - start)
+    trailing = has_before & ~has_after
+    filled[trailing] = minutes[before[trailing]]
+    return filled
+
+def _trip_ordered(rows):
+    """Whether each trip's rows are contiguous and in stop_sequence order"""
+    trip_id = rows['trip_id'].to_numpy()
+    boundary = trip_id[1:] != trip_id[:-1]
+    if (~boundary & (np.diff(rows['stop_sequence'].to_numpy()) < 0)).any():
+        return False
+    return pd.Index(trip_id[np.r_[True, boundary]] if len(trip_id) else trip_id).is_unique
+
+def _read_ids(gtfs_dir, filename, column):
+    path = os.path.join(gtfs_dir, filename)
+    if not os.path.exists(path):
+        return None
+    return pd.Index(pd.read_csv(path, usecols=[column], dtype=str)[column]).drop_duplicates()
+
+def tsa_ids(gtfs_dir, filename, column):
+    """Series from a column's IDs as written to the IDs tsa.load_gtfs gives them
+
+    tsa reads feed tables with pandas' type inference and then coerces IDs to
+    str, so numeric IDs lose their zero padding ('00036' -> '36').
+    """
+    path = os.path.join(gtfs_dir, filename)
+    written = pd.read_csv(path, usecols=[column], dtype=str)[column].to_numpy()
+    read = pd.read_csv(path, usecols=[column])[column].astype(str).to_numpy()
+    ids = pd.Series(read, index=written)
+    return ids[~ids.index.duplicated()]
+
+def _map_ids(values, ids):
+    """values through a tsa_ids map; IDs it lacks (e.g. unknown stops) are kept"""
+    return values.map(ids).fillna(values)
+
+def active_trip_ids(gtfs_dir, service_date):
+    """trip_ids running on service_date (YYYYMMDD), by the calendar rules tsa.load_gtfs applies"""
+    day = pd.Timestamp(service_date).day_name().lower()
+    date = int(service_date)
+    service_ids = []
+    calendar_path = os.path.join(gtfs_dir, 'calendar.txt')
+    if os.path.exists(calendar_path):
+        calendar = pd.read_csv(calendar_path, dtype=str)
+        running = (
+            (pd.to_numeric(calendar['start_date']) <= date)
+            & (pd.to_numeric(calendar['end_date']) >= date)
+            & (pd.to_numeric(calendar[day]) == 1)
+        )
+        service_ids = calendar['service_id'][running].tolist()
+    dates_path = os.path.join(gtfs_dir, 'calendar_dates.txt')
+    if os.path.exists(dates_path):
+        dates = pd.read_csv(dates_path, dtype=str)
+        dates = dates[pd.to_numeric(dates['date']) == date]
+        exception = pd.to_numeric(dates['exception_type'])
+        removed = set(dates['service_id'][exception == 2])
+        service_ids = [s for s in dates['service_id'][exception == 1].tolist() + service_ids if s not in removed]
+    if not service_ids:
+        raise ValueError(f"No service found in {gtfs_dir} on {service_date}")
+    trips = pd.read_csv(os.path.join(gtfs_dir, 'trips.txt'), dtype=str, usecols=['trip_id', 'service_id'])
+    return trips['trip_id'][trips['service_id'].isin(service_ids)].to_numpy()
+
+# Rough pandas footprint of one stop_times row read as strings, with its per-chunk copies
+STOP_TIMES_ROW_BYTES = 1024
+
+def spill_plan(stop_times_bytes, budget_bytes):
+    """(partitions, chunk_size) keeping a chunk and a spilled partition each within a quarter of the budget"""
+    chunk_size = int(min(SCAN_CHUNK_SIZE, max(10_000, budget_bytes // 4 // STOP_TIMES_ROW_BYTES)))
+    partitions = max(1, math.ceil(4 * stop_times_bytes / budget_bytes))
+    return partitions, chunk_size
+
+class SpillPartitions:
+    """Partial aggregates appended to CSV files under directory, partitioned by a hash of one key column
+
+    Rows with the same key always land in the same partition, so each
+    partition can be reduced on its own with only that partition in memory.
+    Missing float values read back as NaN; strings are read back verbatim.
+    """
+    def __init__(self, directory, name, dtypes, partitions):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f'{name}_{i}.csv') for i in range(partitions)]
+        self.dtypes = dtypes
+
+    def append(self, frame, key):
+        frame = frame[list(self.dtypes)]
+        if len(self.paths) == 1:
+            parts = [(0, frame)]
+        else:
+            parts = frame.groupby(pd.util.hash_array(frame[key].to_numpy(dtype=object)) % len(self.paths), sort=False)
+        for partition, rows in parts:
+            rows.to_csv(self.paths[partition], mode='a', header=False, index=False)
+
+    def __iter__(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                yield pd.read_csv(path, names=list(self.dtypes), dtype=self.dtypes, header=None, keep_default_na=False,
+                                  na_values={column: [''] for column, dtype in self.dtypes.items() if dtype is np.float64})
+
+def stop_patterns(pattern_rows, trips):
+    """Representative trips the way tsa's schedule patterns pick them
+
+    Within a route, trips with the same stop_id sequence share a pattern,
+    represented by its lowest trip_id. pattern_rows holds SpillPartitions of
+    (at least) trip_id, stop_sequence, stop_id partitioned by trip_id. Returns
+    (patterns, line_stops, rep_trip_ids): rep_trip_id, route_id, direction_id,
+    total_trips as get_total_trips_by_line, the rep trips' trip_id, stop_id
+    rows, and each trip's rep_trip_id indexed by trip_id.
+    """
+    keys = []
+    for rows in pattern_rows:
+        rows = rows.sort_values(['trip_id', 'stop_sequence'], kind='stable')
+        sequences = rows.groupby('trip_id', sort=False)['stop_id'].agg('\x1f'.join)
+        keys.append(pd.Series(pd.util.hash_array(sequences.to_numpy(dtype=object)), index=sequences.index))
+    keys = pd.concat(keys) if keys else pd.Series(dtype=np.uint64)
+    trip_patterns = trips[['route_id', 'direction_id']].join(keys.rename('pattern'), how='inner')
+    trip_patterns = trip_patterns.dropna(subset=['route_id']).rename_axis('trip_id').reset_index()
+    grouped = trip_patterns.groupby(['route_id', 'pattern'])['trip_id']
+    rep_trip_ids = pd.Series(grouped.transform('min').to_numpy(), index=trip_patterns['trip_id'].to_numpy())
+    patterns = pd.DataFrame({'rep_trip_id': grouped.min(), 'total_trips': grouped.size()}).reset_index(drop=True)
+    patterns = patterns.merge(trip_patterns[['trip_id', 'route_id', 'direction_id']], left_on='rep_trip_id', right_on='trip_id')
+    patterns = patterns.sort_values('rep_trip_id')[['rep_trip_id', 'route_id', 'direction_id', 'total_trips']].reset_index(drop=True)
+    patterns['direction_id'] = pd.to_numeric(patterns['direction_id'])
+
+    rep_trips = pd.Index(patterns['rep_trip_id'])
+    line_stops = [rows[rows['trip_id'].isin(rep_trips)] for rows in pattern_rows]
+    if not line_stops:
+        return patterns, pd.DataFrame(columns=['trip_id', 'stop_id']), rep_trip_ids
+    line_stops = pd.concat(line_stops).sort_values(['trip_id', 'stop_sequence'], kind='stable')
+    return patterns, line_stops[['trip_id', 'stop_id']].reset_index(drop=True), rep_trip_ids
+
+class FeedScan:
+    """What one pass over a feed's stop_times.txt gathered
+
+    stop_hours has stop_id, hour, departures for the active trips. trips is
+    indexed by trip_id (active trips only) with route_id, direction_id,
+    first_sequence, first_departure (service-day minutes) and stop_count.
+    departures is (stop_id, minute) arrays of the active departures, when
+    kept (for spilled scans, SpillPartitions of stop_id, minute). anomalies
+    counts each check over the whole feed. Spilled scans also carry stops (stop_id, stop_lat, stop_lon of the stops the active trips
+    use), patterns and line_stops (see stop_patterns), and their trips a rep_trip_id column.
+    """
+    def __init__(self, stop_hours, trips, departures, anomalies, stops=None, patterns=None, line_stops=None):
+        self.stop_hours = stop_hours
+        self.trips = trips
+        self.departures = departures
+        self.anomalies = anomalies
+        self.stops = stops
+        self.patterns = patterns
+        self.line_stops = line_stops
+
+def scan_feed(gtfs_dir, active_trip_ids=None, keep_departures=False, chunk_size=SCAN_CHUNK_SIZE, spill_dir=None, partitions=1):
+    """Aggregate, index and validate stop_times.txt in one chunked read
+
+    active_trip_ids limits the aggregates and indices to the trips running on
+    the service date (e.g. service.trips from tsa); every trip is validated.
+    Untimed stops are interpolated over whole trips: the rows of the trip a
+    chunk ends on are held for the next chunk, and if a trip's rows turn out to
+    be spread through the file while some stops need interpolating, the file
+    is scanned again as one chunk.
+    With spill_dir, the active trips' stop rows go to SpillPartitions there
+    by trip_id hash and are aggregated one partition (of whole trips) at a
+    time, the stop aggregates are spilled by stop_id hash and reduced the same
+    way, and the scan also derives what build_scan_matrices needs in place of
+    a tsa service: trip, stop and route IDs are then the ones tsa would give
+    them (see tsa_ids, applied by the IDs of trips.txt and stops.txt), and the
+    active trips' frequencies.txt rows are counted as frequencies_not_expanded.
+    """
+    trips = pd.read_csv(os.path.join(gtfs_dir, 'trips.txt'), dtype=str)
+    if 'direction_id' not in trips:
+        trips['direction_id'] = np.nan
+    trips = trips.drop_duplicates('trip_id').set_index('trip_id')
+    route_ids = _read_ids(gtfs_dir, 'routes.txt', 'route_id')
+    stop_ids = _read_ids(gtfs_dir, 'stops.txt', 'stop_id')
+    active = pd.Index(trips.index if active_trip_ids is None else pd.unique(np.asarray(active_trip_ids)))
+
+    anomalies = collections.Counter()
+    anomalies['trips_missing_direction_id'] = int(trips['direction_id'].isna().sum())
+    if route_ids is not None:
+        anomalies['trips_unknown_route'] = int((~trips['route_id'].isin(route_ids)).sum())
+
+    stop_hours, firsts, departures = [], [], []
+    if spill_dir:
+        stop_hours = SpillPartitions(spill_dir, 'stop_hours', {'stop_id': str, 'hour': np.int64, 'departures': np.int64}, partitions)
+        trip_rows = SpillPartitions(spill_dir, 'trip_rows', {'trip_id': str, 'stop_sequence': np.float64, 'stop_id': str, 'minute': np.float64}, partitions)
+        used_stops = set()
+        trip_ids, feed_stop_ids = tsa_ids(gtfs_dir, 'trips.txt', 'trip_id'), tsa_ids(gtfs_dir, 'stops.txt', 'stop_id')
+        frequencies_path = os.path.join(gtfs_dir, 'frequencies.txt')
+        if os.path.exists(frequencies_path):
+            frequencies = pd.read_csv(frequencies_path, dtype=str, usecols=['trip_id'])
+            anomalies['frequencies_not_expanded'] = int(frequencies['trip_id'].isin(active).sum())
+        if keep_departures:
+            departures = SpillPartitions(spill_dir, 'departures', {'stop_id': str, 'minute': np.int64}, partitions)
+
+    def aggregate(rows):
+        """Interpolate, index and aggregate rows holding whole trips"""
+        if np.isnan(rows['minute'].to_numpy()).any():
+            if not _trip_ordered(rows):
+                rows = rows.sort_values(['trip_id', 'stop_sequence'], kind='stable')
+            rows = rows.assign(minute=interpolate_trip_minutes(rows['trip_id'].to_numpy(), rows['minute'].to_numpy()))
+        timed = ~np.isnan(rows['minute'].to_numpy())
+        anomalies['stop_times_uninterpolated_departure_time'] += int((~timed).sum())
+        rows = rows.assign(minute=np.where(timed, np.floor(rows['minute'].to_numpy()), -1).astype(np.int64))
+
+        # Per trip: the row with the lowest stop_sequence (a grouped argmin, no sort) and the row count
+        grouped = rows.groupby('trip_id', sort=False)
+        first = rows.loc[grouped['stop_sequence'].idxmin(), ['trip_id', 'stop_sequence', 'minute']]
+        firsts.append(first.assign(stop_count=grouped.size().reindex(first['trip_id']).to_numpy()))
+
+        timed_rows = rows[timed]
+        counts = timed_rows.groupby(['stop_id', timed_rows['minute'] // 60]).size()
+        if spill_dir:
+            stop_hours.append(counts.rename('departures').rename_axis(['stop_id', 'hour']).reset_index(), 'stop_id')
+            used_stops.update(rows['stop_id'].unique())
+        else:
+            stop_hours.append(counts)
+        if keep_departures and spill_dir:
+            departures.append(timed_rows, 'stop_id')
+        elif keep_departures:
+            departures.append((timed_rows['stop_id'].to_numpy(), timed_rows['minute'].to_numpy()))
+
+    previous, held = None, None
+    rows_read, aggregated, untimed, spread = 0, set(), False, False
+    reader = pd.read_csv(os.path.join(gtfs_dir, 'stop_times.txt'), dtype=str, chunksize=chunk_size,
+                         usecols=['trip_id', 'stop_id', 'stop_sequence', 'departure_time'])
+    for chunk in reader:
+        sequence = pd.to_numeric(chunk['stop_sequence'], errors='coerce').to_numpy()
+        trip_id = chunk['trip_id'].to_numpy()
+        anomalies['stop_times_bad_stop_sequence'] += int(np.isnan(sequence).sum())
+        anomalies['stop_times_orphan_trip'] += int((~chunk['trip_id'].isin(trips.index)).sum())
+        if stop_ids is not None:
+            anomalies['stop_times_unknown_stop'] += int((~chunk['stop_id'].isin(stop_ids)).sum())
+        last_trip = trip_id[-1]
+        rows_read += len(chunk)
+
+        # stop_sequence must increase along each trip's rows, including across chunks
+        if previous is not None:
+            trip_id = np.concatenate([[previous[0]], trip_id])
+            sequence = np.concatenate([[previous[1]], sequence])
+        same_trip = trip_id[1:] == trip_id[:-1]
+        step = np.diff(sequence)
+        anomalies['stop_times_unsorted_stop_sequence'] += int((same_trip & (step < 0)).sum())
+        anomalies['stop_times_duplicate_stop_sequence'] += int((same_trip & (step == 0)).sum())
+        previous = (trip_id[-1], sequence[-1])
+
+        chunk['stop_sequence'] = pd.to_numeric(chunk['stop_sequence'], errors='coerce')
+        chunk = chunk[chunk['trip_id'].isin(active)].dropna(subset=['stop_sequence'])
+        minute = gtfs_minutes(chunk['departure_time'])
+        anomalies['stop_times_bad_departure_time'] += int((np.isnan(minute) & chunk['departure_time'].notna().to_numpy()).sum())
+        chunk = chunk[['trip_id', 'stop_id', 'stop_sequence']].assign(minute=minute)
+        if spill_dir:
+            chunk = chunk.assign(trip_id=_map_ids(chunk['trip_id'], trip_ids), stop_id=_map_ids(chunk['stop_id'], feed_stop_ids))
+            trip_rows.append(chunk, 'trip_id')
+            continue
+
+        # Hold the trip the chunk ends on until its remaining rows are read
+        untimed = untimed or bool(np.isnan(minute).any())
+        spread = spread or not aggregated.isdisjoint(chunk['trip_id'].unique())
+        if held is not None:
+            chunk = pd.concat([held, chunk])
+        ends = (chunk['trip_id'] == last_trip).to_numpy()
+        held = chunk[ends]
+        if not ends.all():
+            aggregated.update(chunk['trip_id'][~ends].unique())
+            aggregate(chunk[~ends])
+    if spill_dir:
+        for rows in trip_rows:
+            aggregate(rows)
+        trips = trips.set_axis(pd.Index(_map_ids(trips.index.to_series(), trip_ids), name='trip_id'))
+        trips['route_id'] = _map_ids(trips['route_id'], tsa_ids(gtfs_dir, 'trips.txt', 'route_id'))
+        active = pd.Index(_map_ids(active.to_series(), trip_ids))
+    elif spread and untimed and rows_read > chunk_size:
+        # Trips were aggregated before all their rows were read, so their untimed stops need another pass
+        return scan_feed(gtfs_dir, active_trip_ids, keep_departures, rows_read)
+    elif held is not None and len(held):
+        aggregate(held)
+
+    firsts = pd.concat(firsts, ignore_index=True) if firsts else pd.DataFrame(columns=['trip_id', 'stop_sequence', 'minute', 'stop_count'])
+    stop_count = firsts.groupby('trip_id')['stop_count'].sum()
+    firsts = firsts.loc[firsts.groupby('trip_id')['stop_sequence'].idxmin()] if len(firsts) else firsts
+    trip_index = pd.DataFrame({
+        'first_sequence': firsts['stop_sequence'].to_numpy(),
+        'first_departure': firsts['minute'].to_numpy(),
+    }, index=pd.Index(firsts['trip_id'], name='trip_id'))
+    trip_index['stop_count'] = stop_count.reindex(trip_index.index).to_numpy()
+    trip_index = trip_index.join(trips[['route_id', 'direction_id']])
+    trip_index['direction_id'] = pd.to_numeric(trip_index['direction_id'], errors='coerce').astype('Int64')
+
+    anomalies['trips_without_stop_times'] = int((~trips.index.isin(trip_index.index) & trips.index.isin(active)).sum())
+    anomalies['trips_untimed_first_stop'] = int((trip_index['first_departure'] < 0).sum())
+    anomalies['trips_single_stop'] = int((trip_index['stop_count'] < 2).sum())
+
+    if spill_dir:
+        stop_hours = [part.groupby(['stop_id', 'hour'])['departures'].sum() for part in stop_hours]
+    stop_hours = pd.concat(stop_hours) if stop_hours else pd.Series(dtype=np.int64, index=pd.MultiIndex.from_arrays([[], []]))
+    stop_hours = stop_hours.groupby(level=[0, 1]).sum().rename('departures').reset_index()
+    stop_hours.columns = ['stop_id', 'hour', 'departures']
+    if keep_departures and not spill_dir:
+        departures = tuple(np.concatenate(parts) for parts in zip(*departures)) if departures else (np.zeros(0, dtype=object), np.zeros(0, dtype=np.int64))
+    elif not keep_departures:
+        departures = None
+    if not spill_dir:
+        return FeedScan(stop_hours, trip_index, departures, dict(anomalies))
+
+    stops = pd.read_csv(os.path.join(gtfs_dir, 'stops.txt'), dtype=str, usecols=['stop_id', 'stop_lat', 'stop_lon'])
+    stops['stop_id'] = _map_ids(stops['stop_id'], feed_stop_ids)
+    stops = stops[stops['stop_id'].isin(used_stops)].reset_index(drop=True)
+    stops[['stop_lat', 'stop_lon']] = stops[['stop_lat', 'stop_lon']].apply(pd.to_numeric, errors='coerce')
+    patterns, line_stops, rep_trip_ids = stop_patterns(trip_rows, trips.loc[trips.index.isin(active)])
+    trip_index['rep_trip_id'] = rep_trip_ids.reindex(trip_index.index).to_numpy()
+    return FeedScan(stop_hours, trip_index, departures, dict(anomalies), stops, patterns, line_stops)
+
+def budgeted_scan(gtfs_dir, service_date, memory_budget, spill_dir, keep_departures=False):
+    """scan_feed for service_date without tsa, sized to a memory budget in MB and spilling under spill_dir"""
+    stop_times_bytes = os.path.getsize(os.path.join(gtfs_dir, 'stop_times.txt'))
+    partitions, chunk_size = spill_plan(stop_times_bytes, memory_budget * 2**20)
+    return scan_feed(gtfs_dir, active_trip_ids(gtfs_dir, service_date), keep_departures, chunk_size, spill_dir, partitions)
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where the resource module is unavailable"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def anomaly_table(scans):
+    """feed,check,count rows for {feed_name: FeedScan}"""
+    return pd.DataFrame(
+        [(feed, check, count) for feed, scan in scans.items() for check, count in sorted(scan.anomalies.items())],
+        columns=['feed', 'check', 'count'],
+    )
+
+# Service-day timeline
+#
+# GTFS times past 24:00 belong to the previous service day but run on the next
+# calendar day. The hour_N columns keep them on their service day, so a night
+# rule on the weekday matrix never sees the following morning's own trips, nor
+# the weekend feed's overflow. The timeline lays both feeds out over one
+# calendar week so night windows can be counted across that boundary.
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# Calendar days each reference feed stands in for
+WEEKDAY_FEED_DAYS = [0, 1, 2, 3, 4]
+WEEKEND_FEED_DAYS = [5, 6]
+
+class ServiceTimeline:
+    """Departures of every stop over one calendar week, at minute resolution
+
+    keys holds stop * MINUTES_PER_WEEK + minute_of_week for each departure,
+    sorted, so each stop's departures form one contiguous ascending run and a
+    window count for every stop is two searchsorted calls.
+    """
+    def __init__(self, n_stops, keys):
+        self.n_stops = n_stops
+        self.keys = keys
+
+    def window_counts(self, start, end):
+        """Departures per stop in calendar minutes [start, end) of the week, wrapping past Sunday"""
+        length = end - start
+        start %= MINUTES_PER_WEEK
+        end = start + length
+        if end > MINUTES_PER_WEEK:
+            return self.window_counts(start, MINUTES_PER_WEEK) + self.window_counts(0, end - MINUTES_PER_WEEK)
+        base = np.arange(self.n_stops, dtype=np.int64) * MINUTES_PER_WEEK
+        return np.searchsorted(self.keys, base + end) - np.searchsorted(self.keys, base + start)
+
+    def service_hour_counts(self, day, hour):
+        """Departures per stop in service-day hour `hour` of `day` (hour 25 is 01:00 the next day)"""
+        start = day * MINUTES_PER_DAY + hour * 60
+        return self.window_counts(start, start + 60)
+
+def build_timeline(stop_ids, feeds):
+    """Fold departures onto a calendar week over the stop_ids axis
+
+    feeds is a list of (stop_id, minute, days): service_departures (or
+    FeedScan.departures) and the WEEKDAYS indexes the feed represents. Each
+    departure is placed on every one of its days, with minutes past midnight
+    carried into the next day (and Sunday's overflow into Monday).
+    """
+    stop_index = pd.Index(stop_ids)
+    keys = []
+    for stop_id, minute, days in feeds:
+        codes = stop_index.get_indexer(stop_id)
+        keep = codes >= 0
+        codes = codes[keep].astype(np.int64) * MINUTES_PER_WEEK
+        minute = minute[keep]
+        for day in days:
+            keys.append(codes + (day * MINUTES_PER_DAY + minute) % MINUTES_PER_WEEK)
+    keys = np.sort(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+    return ServiceTimeline(len(stop_index), keys)
+
+class NightHourCounts:
+    """Precomputed service_hour_counts for the (day, hour) pairs the night rules ask for
+
+    Stands in for a ServiceTimeline when the departures are spilled and never
+    held in memory at once.
+    """
+    def __init__(self, counts):
+        self.counts = counts
+
+    def service_hour_counts(self, day, hour):
+        return self.counts[day, hour]
+
+def night_hour_pairs(levels, night_days):
+    """(day, service hour) pairs counted by the night segments of compiled levels on night_days"""
+    return sorted({
+        (day, int(hour))
+        for level in levels.values() for segment in level.night_segments for hour in segment.hours
+        for day in night_days
+    })
+
+def departure_batches(feeds):
+    """build_timeline feeds from spilled scans, one (stop_id, minute, days) batch per partition
+
+    feeds is a list of (FeedScan, days) whose departures are SpillPartitions.
+    """
+    for scan, days in feeds:
+        for part in scan.departures:
+            yield part['stop_id'].to_numpy(dtype=object), part['minute'].to_numpy(), days
+
+def count_night_hours(stop_ids, batches, pairs):
+    """Sum service_hour_counts over departure batches for each (day, hour) in pairs
+
+    Counts are additive across batches, so the result matches one timeline
+    built from every batch, with only one batch's timeline in memory.
+    """
+    counts = {pair: np.zeros(len(stop_ids), dtype=np.int64) for pair in pairs}
+    for batch in batches:
+        timeline = build_timeline(stop_ids, [batch])
+        for day, hour in pairs:
+            counts[day, hour] += timeline.service_hour_counts(day, hour)
+    return NightHourCounts(counts)
+
+def _timeline_night_margin(timeline, segment, night_days):
+    """Smallest night segment margin across the service nights in night_days"""
+    margins = [
+        sum(timeline.service_hour_counts(day, hour) for hour in segment.hours) - segment.min_total
+        for day in night_days
+    ]
+    return np.min(margins, axis=0)
+
+def _stop_level_margins(level, weekday, timeline=None, night_days=(0,)):
+    """Criteria names and margins of the stop-level tests (empty for route-only levels)"""
+    if level.total_trips_threshold is not None:
+        return [], []
+    stop_criteria, stop_margins = [], []
+    for period in ('peak', 'extended'):
+        if period in level.periods:
+            min_tph, total = _stop_window_margins(weekday, level.periods[period])
+            stop_criteria += [f'{period}_min_tph', f'{period}_total']
+            stop_margins += [min_tph, total]
+    for i, segment in enumerate(level.night_segments):
+        stop_criteria.append(f'night_{i}')
+        if timeline is not None:
+            stop_margins.append(_timeline_night_margin(timeline, segment, night_days))
+        else:
+            stop_margins.append(weekday.stop_window(segment)[1] - segment.min_total)
+    if stop_margins:
+        stop_criteria.insert(0, 'service')
+        stop_margins.insert(0, _served_margin(weekday))
+    return stop_criteria, stop_margins
+
+def stop_level_mask(level, weekday, timeline=None, night_days=(0,)):
+    """Stops passing every stop-level test of a compiled level"""
+    stop_criteria, stop_margins = _stop_level_margins(level, weekday, timeline, night_days)
+    if not stop_margins:
+        return np.zeros(len(weekday.stop_ids), dtype=bool)
+    return np.min(stop_margins, axis=0) >= 0
+
+def evaluate_level(level, weekday, weekend, timeline=None, night_days=(0,), stop_passes_elsewhere=False):
+    """Evaluate one service level over the weekday stop axis
+
+    Returns (criteria, margins) where margins[c, i] is how far stop i clears
+    criterion c (negative when it fails). A stop is in the level when every
+    margin is non-negative. Criteria are listed in the order
+    process_service_level applies them, including its quirk of falling back to
+    the route-level stops when no stop passes the stop-level filters.
+
+    With a timeline (a ServiceTimeline, or NightHourCounts for spilled
+    departures), night segments are counted in calendar time for each
+    service night in night_days (WEEKDAYS indexes) and must hold on all of
+    them, instead of on the weekday feed's own hour columns.
+
+    stop_passes_elsewhere is for evaluating a subset of the stop axis: it
+    tells the fallback that a stop outside the subset passes the stop-level
+    tests.
+    """
+    if level.total_trips_threshold is not None:
+        row_margin = weekday.totals.counts[:, 0] - level.total_trips_threshold
+        return ['route_total'], np.array([_route_stop_margin(weekday, weekday.totals, row_margin)])
+
+    stop_criteria, stop_margins = _stop_level_margins(level, weekday, timeline, night_days)
+    criteria, margins = [], []
+    if stop_margins and (stop_passes_elsewhere or (np.min(stop_margins, axis=0) >= 0).any()):
+        criteria += stop_criteria
+        margins += stop_margins
+
+    if level.route_window:
+        criteria.append('route')
+        margins.append(_route_window_margin(weekday, level.route_window))
+    elif not criteria:
+        criteria.append('service')
+        margins.append(np.full(len(weekday.stop_ids), -1))
+
+    if level.weekend_required and 'weekend' in level.periods:
+        min_tph, total = _stop_window_margins(weekend, level.periods['weekend'])
+        criteria += ['weekend_service', 'weekend_min_tph', 'weekend_total', 'weekend_route']
+        margins += [_served_margin(weekend), min_tph, total, _route_window_margin(weekend, level.periods['weekend'])]
+
+    return criteria, np.array(margins, dtype=np.int64)
+
+def level_mask(margins):
+    """Stops passing every criterion of an evaluate_level result"""
+    return (margins >= 0).all(axis=0)
+
+def classify_stops(levels, weekday, weekend, timeline=None, night_days=(0,)):
+    """Evaluate every service level; returns {level_name: (criteria, margins)}"""
+    return {
+        name: evaluate_level(level, weekday, weekend, timeline, night_days)
+        for name, level in compile_levels(levels).items()
+    }
+
+# Set in each pool worker by _attach_worker
+_worker_matrices = None
+
+def _attach_worker(cache_dir):
+    global _worker_matrices
+    _worker_matrices = load_service_cache(cache_dir, mmap_mode='r')
+
+def _evaluate_variant(levels):
+    weekday, weekend = _worker_matrices
+    evaluations = classify_stops(levels, weekday, weekend)
+    return {name: np.packbits(level_mask(margins)) for name, (criteria, margins) in evaluations.items()}
+
+def evaluate_variants(cache_dir, variants, workers=None):
+    """Evaluate {variant_name: levels} configs against one matrix cache in a process pool
+
+    Workers map the cached .npy files read-only instead of receiving pickled
+    frames, so the matrices live once in the page cache however many workers
+    run. Only the configs go out and packed level bitmasks come back. Returns
+    {variant_name: {level_name: stop mask}} over the cached weekday stop_ids.
+    """
+    n_stops = len(np.load(os.path.join(cache_dir, 'weekday', 'stop_ids.npy'), mmap_mode='r'))
+    with ProcessPoolExecutor(workers, initializer=_attach_worker, initargs=(cache_dir,)) as pool:
+        packed = dict(zip(variants, pool.map(_evaluate_variant, variants.values())))
+    return {
+        variant: {name: np.unpackbits(bits, count=n_stops).astype(bool) for name, bits in masks.items()}
+        for variant, masks in packed.items()
+    }
+
+def _route_frame(matrices, table):
+    return pd.DataFrame({
+        'route_id': np.asarray(matrices.route_ids)[table.route],
+        'direction_id': np.asarray(table.direction),
+    })
+
+# Level whose peak/extended/weekend windows the route table sums trips over
+ROUTE_WINDOW_LEVEL = 'level1'
+
+def _period_hours(level, period):
+    return level.periods[period].hours if period in level.periods else []
+
+def route_report(levels, weekday, weekend, window_level=ROUTE_WINDOW_LEVEL):
+    """One row per weekday route/direction from the same pivots the levels use
+
+    levels lists the level_columns whose route-level tests the route/direction
+    passes on its own (the stop expansion then applies them per route_id),
+    peak/extended/weekend_trips sum the trips in the windows of the
+    window_level level (0 where it has no such window), and
+    first_hour/last_hour span the weekday hours with trips.
+    """
+    levels = compile_levels(levels)
+    if window_level not in levels:
+        raise ValueError(f"route window level {window_level!r} is not one of {', '.join(levels)}")
+    windows = levels[window_level]
+    by_hour = weekday.by_hour.counts
+    report = _route_frame(weekday, weekday.by_hour)
+    report['peak_trips'] = by_hour[:, _period_hours(windows, 'peak')].sum(axis=1)
+    report['extended_trips'] = by_hour[:, _period_hours(windows, 'extended')].sum(axis=1)
+    running = by_hour > 0
+    report['first_hour'] = np.where(running.any(axis=1), running.argmax(axis=1), -1)
+    report['last_hour'] = np.where(running.any(axis=1), by_hour.shape[1] - 1 - running[:, ::-1].argmax(axis=1), -1)
+
+    weekend_rows = _route_frame(weekend, weekend.by_hour)
+    weekend_rows['weekend_trips'] = weekend.by_hour.counts[:, _period_hours(windows, 'weekend')].sum(axis=1)
+    totals = _route_frame(weekday, weekday.totals)
+    totals['total_trips'] = weekday.totals.counts[:, 0]
+
+    qualifying = []
+    for level in levels.values():
+        if level.total_trips_threshold is not None:
+            passed = totals[['route_id', 'direction_id']][totals['total_trips'] >= level.total_trips_threshold]
+        else:
+            if not level.route_window:
+                continue
+            passed = report[['route_id', 'direction_id']][_route_row_margin(weekday.by_hour, level.route_window) >= 0]
+            if level.weekend_required and 'weekend' in level.periods:
+                weekend_passed = weekend_rows[['route_id', 'direction_id']][_route_row_margin(weekend.by_hour, level.periods['weekend']) >= 0]
+                passed = passed.merge(weekend_passed, on=['route_id', 'direction_id'])
+        qualifying.append(passed.assign(level=level.level_column))
+
+    report = report.merge(weekend_rows, how='left', on=['route_id', 'direction_id'])
+    report = report.merge(totals, how='left', on=['route_id', 'direction_id'])
+    qualifying.append(pd.DataFrame(columns=['route_id', 'direction_id', 'level']))
+    level_names = pd.concat(qualifying).groupby(['route_id', 'direction_id'], sort=False)['level'].agg(';'.join)
+    report = report.merge(level_names.rename('levels').reset_index(), how='left', on=['route_id', 'direction_id'])
+    report['levels'] = report['levels'].fillna('')
+    report[['weekend_trips', 'total_trips']] = report[['weekend_trips', 'total_trips']].fillna(0).astype(np.int64)
+    columns = ['route_id', 'direction_id', 'levels', 'peak_trips', 'extended_trips', 'weekend_trips', 'total_trips', 'first_hour', 'last_hour']
+    return report[columns].sort_values(['route_id', 'direction_id'], kind='stable').reset_index(drop=True)
+
+def explain_levels(levels, evaluations, stop_ids):
+    """Per-stop first failing criterion and margin for every level
+
+    <level>_fail is the first criterion the stop fails (empty when it is in
+    the level) and <level>_margin is that criterion's margin, or for passing
+    stops the smallest margin across all criteria.
+    """
+    columns = {'stop_id': stop_ids}
+    for name, level in compile_levels(levels).items():
+        criteria, margins = evaluations[name]
+        failed = margins < 0
+        first = failed.argmax(axis=0)
+        passed = ~failed.any(axis=0)
+        names = np.array(criteria, dtype=object)[first]
+        names[passed] = ''
+        margin = margins[first, np.arange(margins.shape[1])]
+        margin[passed] = margins[:, passed].min(axis=0)
+        columns[f"{level.level_column}_fail"] = names
+        columns[f"{level.level_column}_margin"] = margin
+    return pd.DataFrame(columns)
+
+def write_table(frame, filename):
+    """Write frame as Parquet when the name ends in .parquet, else CSV"""
+    if filename.endswith('.parquet'):
+        frame.to_parquet(filename, index=False)
+    else:
+        frame.to_csv(filename, index=False)
+
+# Output
+#
+# Rows are streamed in stop_id order straight from the level masks, in fixed
+# chunks and with fixed float formatting, so the same inputs always produce the
+# same bytes regardless of how the classification was scheduled.
+
+# The reference CSV's level columns, in its order. levelAll (every stop with service) is classified but, as
+# there, not written; a levels file's other levels follow in file order
+OUTPUT_LEVEL_COLUMNS = ['level6', 'level5', 'level4', 'level3', 'level2', 'level1', 'levelNights']
+UNWRITTEN_LEVEL_COLUMNS = ['levelAll']
+OUTPUT_FORMATS = {'.csv': 'csv', '.geojsonl': 'geojsonl', '.geojsons': 'geojsonl', '.ndjson': 'geojsonl', '.fgb': 'fgb'}
+WRITE_CHUNK_SIZE = 65536
+
+def output_level_columns(level_columns):
+    """Columns written for the given level columns: OUTPUT_LEVEL_COLUMNS first, then the rest in order"""
+    level_columns = list(level_columns)
+    return [c for c in OUTPUT_LEVEL_COLUMNS if c in level_columns] + [
+        c for c in level_columns if c not in OUTPUT_LEVEL_COLUMNS and c not in UNWRITTEN_LEVEL_COLUMNS
+    ]
+
+def output_chunks(stop_ids, stop_lat, stop_lon, level_masks, chunk_size=WRITE_CHUNK_SIZE):
+    """Yield (stop_ids, stop_lat, stop_lon, {level_column: mask}) chunks in stop_id order
+
+    Only stops that are in the stops table (finite coordinates) or in any
+    level are written, as with the outer merge this replaces.
+    """
+    stop_ids = np.asarray(stop_ids, dtype=str)
+    keep = ~np.isnan(stop_lat)
+    for mask in level_masks.values():
+        keep |= mask
+    rows = np.flatnonzero(keep)
+    rows = rows[np.argsort(stop_ids[rows], kind='stable')]
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        yield stop_ids[chunk], stop_lat[chunk], stop_lon[chunk], {c: m[chunk] for c, m in level_masks.items()}
+
+def _coordinate(value):
+    return '' if np.isnan(value) else repr(float(value))
+
+def write_csv(filename, chunks, columns):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['stop_id'] + columns + ['stop_lat', 'stop_lon'])
+        for stop_ids, stop_lat, stop_lon, masks in chunks:
+            flags = [np.where(masks[c], '1', '') for c in columns]
+            writer.writerows(
+                [stop_id, *(flag[i] for flag in flags), _coordinate(stop_lat[i]), _coordinate(stop_lon[i])]
+                for i, stop_id in enumerate(stop_ids)
+            )
+
+def _feature(stop_id, lat, lon, levels):
+    geometry = None if np.isnan(lat) else {'type': 'Point', 'coordinates': [float(lon), float(lat)]}
+    return {'type': 'Feature', 'geometry': geometry, 'properties': {'stop_id': str(stop_id), **levels}}
+
+def write_geojsonl(filename, chunks, columns):
+    """Newline-delimited GeoJSON, one Feature per stop"""
+    with open(filename, 'w', newline='') as f:
+        for stop_ids, stop_lat, stop_lon, masks in chunks:
+            for i, stop_id in enumerate(stop_ids):
+                levels = {c: bool(masks[c][i]) for c in columns}
+                f.write(json.dumps(_feature(stop_id, stop_lat[i], stop_lon[i], levels), separators=(',', ':')))
+                f.write('\n')
+
+def write_flatgeobuf(filename, chunks, columns):
+    import fiona
+    schema = {'geometry': 'Point', 'properties': {'stop_id': 'str', **{c: 'bool' for c in columns}}}
+    with fiona.open(filename, 'w', driver='FlatGeobuf', schema=schema, crs='EPSG:4326') as dst:
+        for stop_ids, stop_lat, stop_lon, masks in chunks:
+            dst.writerecords(
+                _feature(stop_id, stop_lat[i], stop_lon[i], {c: bool(masks[c][i]) for c in columns})
+                for i, stop_id in enumerate(stop_ids)
+            )
+
+def write_output(filename, stop_ids, stop_lat, stop_lon, level_masks, output_format=None):
+    """Write the per-stop level table as csv, geojsonl or fgb (inferred from the extension by default)
+
+    level_masks is keyed by level column; the columns written are
+    output_level_columns of its keys.
+    """
+    output_format = output_format or OUTPUT_FORMATS.get(os.path.splitext(filename)[1].lower(), 'csv')
+    writer = {'csv': write_csv, 'geojsonl': write_geojsonl, 'fgb': write_flatgeobuf}[output_format]
+    writer(filename, output_chunks(stop_ids, stop_lat, stop_lon, level_masks), output_level_columns(level_masks))
+
+# Hourly departure tile
+#
+# The weekday and weekend stop x hour matrices as quantized uint8 rows keyed by
+# stop index, followed by the stop_id dictionary, so a client gets hourly
+# counts without re-bucketing departures. The format is decoded (and tested
+# against a tile written here, testdata/wsdot/hourly-tile.bin) by
+# decodeHourlyTile in src/analysis/wsdot/hourly-tile.ts; no viewer component
+# loads tiles yet.
+
+TILE_MAGIC = b'WSHT'
+TILE_VERSION = 1
+# magic, version, n_planes, n_stops, n_hours, scale, ids_offset, ids_length
+TILE_HEADER = struct.Struct('<4sHHIHHII')
+
+def tile_scale(planes):
+    """Smallest integer divisor that fits every count of every plane in a uint8"""
+    peak = max((int(plane.max()) for plane in planes if plane.size), default=0)
+    return max(1, -(-peak // 255))
+
+def write_hourly_tile(filename, stop_ids, planes, chunk_size=WRITE_CHUNK_SIZE):
+    """Write stop x hour count planes (weekday, weekend) as a binary tile
+
+    Little-endian TILE_HEADER, then each plane as n_stops rows of n_hours
+    uint8 values round(count / scale), then stop_ids as UTF-8 joined by
+    newlines. Row i of every plane is stop_ids[i].
+    """
+    n_stops, n_hours = planes[0].shape
+    scale = tile_scale(planes)
+    ids = '\n'.join(str(stop_id) for stop_id in stop_ids).encode('utf-8')
+    ids_offset = TILE_HEADER.size + len(planes) * n_stops * n_hours
+    with open(filename, 'wb') as f:
+        f.write(TILE_HEADER.pack(TILE_MAGIC, TILE_VERSION, len(planes), n_stops, n_hours, scale, ids_offset, len(ids)))
+        for plane in planes:
+            for start in range(0, n_stops, chunk_size):
+                chunk = np.asarray(plane[start:start + chunk_size], dtype=np.float64)
+                f.write(np.clip(np.rint(chunk / scale), 0, 255).astype(np.uint8).tobytes())
+        f.write(ids)
+
+def load_services(weekday_dir, weekend_dir, weekday_date, weekend_date, levels, night_days=None, memory_budget=None, spill_dir=None):
+    """(weekday, weekend, timeline, stops, scans) for classify_stops and write_output
+
+    weekday and weekend are ServiceMatrices on the weekday stops, timeline is
+    None unless night_days are given, stops has stop_id, stop_lat, stop_lon
+    and scans is {'weekday': FeedScan, 'weekend': FeedScan} for anomaly_table.
+    With memory_budget (MB) the feeds are scanned without tsa, spilling under
+    a temporary directory in spill_dir.
+    """
+    n_hours = max_config_hour(levels) + 1
+    timeline = None
+    if memory_budget:
+        # tsa.load_gtfs holds every feed table at once, so the bounded path skips it: the scans work out the
+        # active trips, stops and representative trips themselves, spilling to disk as they go
+        with tempfile.TemporaryDirectory(dir=spill_dir) as spill_dir:
+            weekday_scan = budgeted_scan(weekday_dir, weekday_date, memory_budget, os.path.join(spill_dir, 'weekday'), bool(night_days))
+            weekend_scan = budgeted_scan(weekend_dir, weekend_date, memory_budget, os.path.join(spill_dir, 'weekend'), bool(night_days))
+            weekday = build_scan_matrices(weekday_scan, n_hours=n_hours)
+            weekend = build_scan_matrices(weekend_scan, stop_ids=weekday.stop_ids, n_hours=n_hours)
+            if night_days:
+                # The departures stay spilled: the night hours are counted one stop_id partition at a time
+                timeline = count_night_hours(weekday.stop_ids, departure_batches([
+                    (weekday_scan, WEEKDAY_FEED_DAYS),
+                    (weekend_scan, WEEKEND_FEED_DAYS),
+                ]), night_hour_pairs(levels, night_days))
+        stops = weekday_scan.stops
+    else:
+        # import GTFS feeds
+        ## weekday feed
+        weekday_service = tsa.load_gtfs(weekday_dir, weekday_date)
+        ## weekend feed
+        weekend_service = tsa.load_gtfs(weekend_dir, weekend_date)
+
+        # The raw stop_times scan only validates here. tsa's stop_times (frequencies.txt expanded, IDs as tsa reads
+        # them) are what gets aggregated
+        weekday_scan = scan_feed(weekday_dir, active_trip_ids(weekday_dir, weekday_date))
+        weekend_scan = scan_feed(weekend_dir, active_trip_ids(weekend_dir, weekend_date))
+
+        # Aggregate each service once; the weekend is aligned onto the weekday stops
+        weekday = build_service_matrices(weekday_service, n_hours=n_hours)
+        weekend = build_service_matrices(weekend_service, stop_ids=weekday.stop_ids, n_hours=n_hours)
+        if night_days:
+            # Fold both feeds onto one calendar week for the night rules
+            timeline = build_timeline(weekday.stop_ids, [
+                service_departures(weekday_service) + (WEEKDAY_FEED_DAYS,),
+                service_departures(weekend_service) + (WEEKEND_FEED_DAYS,),
+            ])
+        stops = weekday_service.stops
+    return weekday, weekend, timeline, stops, {'weekday': weekday_scan, 'weekend': weekend_scan}
+
+def service_nights(value):
+    """argparse type for --service-day-nights: comma-separated day names to WEEKDAYS indexes"""
+    days = [day.strip().lower()[:3] for day in value.split(',')]
+    unknown = [day for day in days if day not in WEEKDAYS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown day {', '.join(map(repr, unknown))}, expected some of {','.join(WEEKDAYS)}")
+    return [WEEKDAYS.index(day) for day in days]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Classify GTFS stops into WSDOT frequent transit service levels")
+    parser.add_argument('output_filename', help="output file (.csv, .geojsonl or .fgb)")
+    parser.add_argument('monday_dir', help="merged weekday GTFS directory")
+    parser.add_argument('sunday_dir', help="merged weekend GTFS directory")
+    parser.add_argument('--weekday-date', default='20240819', help="weekday service date, YYYYMMDD (default: %(default)s)")
+    parser.add_argument('--weekend-date', default='20240825', help="weekend service date, YYYYMMDD (default: %(default)s)")
+    parser.add_argument('--levels', metavar='PATH', default=DEFAULT_LEVELS_PATH, help="level definitions (.json, or .yaml with PyYAML) (default: the web tool's service-levels.json)")
+    parser.add_argument('--format', choices=['csv', 'geojsonl', 'fgb'], help="output format (default: from the output file extension)")
+    parser.add_argument('--explain', metavar='PATH', help="write the first failing criterion and margin per stop and level (.csv or .parquet)")
+    parser.add_argument('--validation', metavar='PATH', help="write per-feed GTFS anomaly counts gathered while scanning stop_times (.csv or .parquet)")
+    parser.add_argument('--routes', metavar='PATH', help="write the route/direction table with qualifying levels, window trip sums and span (.csv or .parquet)")
+    parser.add_argument('--routes-window-level', metavar='LEVEL', default=ROUTE_WINDOW_LEVEL, help="level whose peak/extended/weekend windows the --routes trip sums use (default: %(default)s)")
+    parser.add_argument('--hourly-tile', metavar='PATH', help="write the weekday/weekend stop x hour departure counts as a binary tile for the web viewer")
+    parser.add_argument('--cache', metavar='DIR', help="save the weekday/weekend frequency matrices under DIR (used by parity.py and --variants)")
+    parser.add_argument('--variants', metavar='JSON', help="evaluate {variant: level definitions in the --levels format} variants against the --cache matrices")
+    parser.add_argument('--variants-out', metavar='PATH', default='variants.csv', help="variant,level,stop_id rows for --variants (default: %(default)s)")
+    parser.add_argument('--service-day-nights', metavar='DAYS', type=service_nights, help="evaluate night segments in calendar time across service-day boundaries for these nights, e.g. 'mon' or 'mon,fri,sat'")
+    parser.add_argument('--census', metavar='PATH', help="block group/tract file (any format geopandas reads) to roll up population served per level")
+    parser.add_argument('--census-id', default='GEOID', help="geography id column in --census (default: %(default)s)")
+    parser.add_argument('--census-population', default='population', help="population column in --census (default: %(default)s)")
+    parser.add_argument('--buffer-radius', type=float, default=805, help="stop buffer radius in meters (default: %(default)s, about half a mile, the --stop-buffer-radius of the report runs in testdata/wsdot/rebuild.sh)")
+    parser.add_argument('--census-out', metavar='PATH', default='coverage.csv', help="per level and geography population output (default: %(default)s)")
+    parser.add_argument('--workers', type=int, help="worker processes for --variants (default: CPU count)")
+    parser.add_argument('--memory-budget', type=int, metavar='MB', help="skip tsa and scan each feed in chunks, spilling partial aggregates partitioned by stop_id/trip_id hash, sized to about this much memory (--service-day-nights departures are spilled too). frequencies.txt is not expanded on this path, so trips defined by it are left out (counted as frequencies_not_expanded in --validation)")
+    parser.add_argument('--spill-dir', metavar='DIR', help="parent directory for --memory-budget spill files (default: the system temp directory)")
+    return parser.parse_args(argv)
+
 def main():
     """Main processing function"""
-    # Check for command line argument
-    if len(sys.argv) < 2:
-        print("Usage: python ian_refactored.py <output_filename.csv> <monday_dir> <sunday_dir>")
-        sys.exit(1)
-    
-    output_filename = sys.argv[1]
+    args = parse_args()
+    output_filename = args.output_filename
+    try:
+        levels = compile_levels(load_levels(args.levels))
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"--levels {args.levels}: {e}")
+    if args.variants:
+        if not args.cache:
+            raise SystemExit("--variants requires --cache")
+        try:
+            with open(args.variants) as f:
+                variants = {variant: parse_levels(document) for variant, document in json.load(f).items()}
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"--variants {args.variants}: {e}")
+    if args.routes and args.routes_window_level not in levels:
+        raise SystemExit(f"--routes-window-level {args.routes_window_level} is not a level in {args.levels}")
     
     # user must separately merge gtfs files before use of this notebook: 
     # combine_gtfs_feeds run -g C:\Users\craigth\pythonwork\FTSS_2024\2024 -s 20240819 -o C:\Users\craigth\pythonwork\FTSS_2024\monday-3
     # combine_gtfs_feeds run -g C:\Users\craigth\pythonwork\FTSS_2024\2024 -s 20240825 -o C:\Users\craigth\pythonwork\FTSS_2024\sunday-3
 
-    # import GTFS feeds
-    ## weekday feed
-    path = sys.argv[2] # r'gtfs/monday-3'
-    weekday_service = tsa.load_gtfs(path, '20240819')
-    ## weekend feed
-    path1 = sys.argv[3] # r'gtfs/sunday-3'
-    weekend_service = tsa.load_gtfs(path1, '20240825')
+    path = args.monday_dir # r'gtfs/monday-3'
+    path1 = args.sunday_dir # r'gtfs/sunday-3'
+    weekday, weekend, timeline, stops, scans = load_services(
+        path, path1, args.weekday_date, args.weekend_date, levels, args.service_day_nights, args.memory_budget, args.spill_dir,
+    )
+
+    validation = anomaly_table(scans)
+    for row in validation[validation['count'] > 0].itertuples(index=False):
+        print(f"WARNING: {row.feed} feed: {row.count} {row.check}")
+    if args.validation:
+        write_table(validation, args.validation)
+
+    if args.cache:
+        save_service_cache(args.cache, weekday, weekend)
+
+    if args.hourly_tile:
+        write_hourly_tile(args.hourly_tile, weekday.stop_ids, [weekday.stop_tph, weekend.stop_tph])
+        print(f"Hourly departure tile written to {args.hourly_tile}")
+
+    night_days = args.service_day_nights or (0,)
 
     # Process all service levels
-    results = {}
-    for level_name, config in SERVICE_LEVELS.items():
-        results[level_name] = process_service_level(level_name, config, weekday_service, weekend_service)
+    evaluations = classify_stops(levels, weekday, weekend, timeline, night_days)
+    level_masks = {}
+    for level_name, (criteria, margins) in evaluations.items():
+        passed = level_mask(margins)
+        level_masks[levels[level_name].level_column] = passed
+        print(f"{level_name}: {passed.sum()} stops ({', '.join(f'{c}: {(m >= 0).sum()}' for c, m in zip(criteria, margins))})")
 
-    # Prepare final output
-    output_data = []
+    if args.explain:
+        write_table(explain_levels(levels, evaluations, weekday.stop_ids), args.explain)
+        print(f"Explanations written to {args.explain}")
 
-    # Add level indicators to each result
-    for level_name, config in SERVICE_LEVELS.items():
-        df = results[level_name][['stop_id']].copy()
-        df[config['level_column']] = '1'
-        output_data.append(df)
+    if args.routes:
+        write_table(route_report(levels, weekday, weekend, args.routes_window_level), args.routes)
+        print(f"Route table written to {args.routes}")
 
     # Get stop coordinates
-    stops = weekday_service.stops[["stop_id", "stop_lat", "stop_lon"]]
+    coords = stops.drop_duplicates('stop_id').set_index('stop_id').reindex(weekday.stop_ids)
+    stop_lat = coords['stop_lat'].to_numpy(dtype=float)
+    stop_lon = coords['stop_lon'].to_numpy(dtype=float)
+
+    if args.census:
+        import census_coverage
+        buffers = census_coverage.stop_buffers(stop_lat, stop_lon, args.buffer_radius)
+        geographies = census_coverage.read_geographies(args.census, args.census_id, args.census_population)
+        served = census_coverage.level_coverage(buffers, level_masks, geographies, args.census_id, args.census_population)
+        write_table(served, args.census_out)
+        print(census_coverage.coverage_summary(served).to_string(index=False))
 
-    # Merge all results
-    final_result = stops
-    for df in output_data:
-        final_result = final_result.merge(df, how='outer', on='stop_id')
+    if args.variants:
+        variant_rows = [
+            pd.DataFrame({'variant': variant, 'level': name, 'stop_id': weekday.stop_ids[mask]})
+            for variant, masks in evaluate_variants(args.cache, variants, args.workers).items()
+            for name, mask in masks.items()
+        ]
+        pd.concat(variant_rows).to_csv(args.variants_out, index=False)
+        print(f"{len(variants)} variants written to {args.variants_out}")
 
-    # Reorder columns to match required header order (without the index column)
-    column_order = ['stop_id', 'level6', 'level5', 'level4', 'level3', 'level2', 'level1', 'levelNights', 'stop_lat', 'stop_lon']
-    final_result = final_result.reindex(columns=column_order)
+    write_output(output_filename, weekday.stop_ids, stop_lat, stop_lon, level_masks, args.format)
+    print(f"\nFinal output written to {output_filename}")
 
-    # Save with index=True to include the integer index starting at 0
-    final_result.to_csv(output_filename, index=False)
-    print(f"\nFinal output: {len(final_result)} total stops written to {output_filename}")
+    if args.memory_budget:
+        peak = peak_rss_mb()
+        if peak is not None:
+            print(f"{'WARNING: ' if peak > args.memory_budget else ''}peak RSS {peak:.0f} MB, budget {args.memory_budget} MB")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,84 @@
+import { readFileSync } from 'node:fs'
+import { describe, expect, it } from 'vitest'
+import { decodeHourlyTile, stopHourlyDepartures, HOURLY_TILE_HEADER_SIZE } from './hourly-tile'
+
+// Build a tile the way wsdot.py write_hourly_tile lays it out
+function encodeTile (stopIds: string[], planes: number[][][], scale: number): ArrayBuffer {
+  const hours = planes[0]?.[0]?.length ?? 0
+  const ids = new TextEncoder().encode(stopIds.join('\n'))
+  const idsOffset = HOURLY_TILE_HEADER_SIZE + planes.length * stopIds.length * hours
+  const buffer = new ArrayBuffer(idsOffset + ids.length)
+  const view = new DataView(buffer)
+  'WSHT'.split('').forEach((c, i) => view.setUint8(i, c.charCodeAt(0)))
+  view.setUint16(4, 1, true)
+  view.setUint16(6, planes.length, true)
+  view.setUint32(8, stopIds.length, true)
+  view.setUint16(12, hours, true)
+  view.setUint16(14, scale, true)
+  view.setUint32(16, idsOffset, true)
+  view.setUint32(20, ids.length, true)
+  const bytes = new Uint8Array(buffer)
+  bytes.set(planes.flat(2), HOURLY_TILE_HEADER_SIZE)
+  bytes.set(ids, idsOffset)
+  return buffer
+}
+
+describe('decodeHourlyTile', () => {
+  const weekday = [[0, 4, 6], [1, 0, 2]]
+  const weekend = [[0, 1, 2], [3, 0, 0]]
+
+  it('reads the header and stop id dictionary', () => {
+    const tile = decodeHourlyTile(encodeTile(['KCM_1', 'ST_é2'], [weekday, weekend], 1))
+    expect(tile.stopIds).toEqual(['KCM_1', 'ST_é2'])
+    expect(tile.planes).toBe(2)
+    expect(tile.hours).toBe(3)
+    expect(tile.counts.length).toBe(12)
+  })
+
+  it('returns scaled hourly counts per stop and plane', () => {
+    const tile = decodeHourlyTile(encodeTile(['a', 'b'], [weekday, weekend], 2))
+    expect(stopHourlyDepartures(tile, 0)).toEqual([0, 8, 12])
+    expect(stopHourlyDepartures(tile, 1, 'weekend')).toEqual([6, 0, 0])
+  })
+
+  it('handles an empty tile', () => {
+    const tile = decodeHourlyTile(encodeTile([], [[], []], 1))
+    expect(tile.stopIds).toEqual([])
+    expect(tile.counts.length).toBe(0)
+  })
+
+  it('rejects other files', () => {
+    expect(() => decodeHourlyTile(new ArrayBuffer(4))).toThrow('truncated')
+    const buffer = encodeTile(['a'], [[[1]], [[1]]], 1)
+    new DataView(buffer).setUint8(0, 0)
+    expect(() => decodeHourlyTile(buffer)).toThrow('Not an hourly departure tile')
+  })
+})
+
+// testdata/wsdot/hourly-tile.bin is written by wsdot.py write_hourly_tile, from
+// docs/wsdot-python:
+//   hours = np.arange(29)
+//   weekday = np.array([(i * 14 + hours * 6) % 80 for i in range(3)]); weekday[0, 8] = 300
+//   weekend = np.array([(i + hours) % 5 * 2 for i in range(3)])
+//   write_hourly_tile('hourly-tile.bin', ['KCM_1', 'ST_é2', 'X_3'], [weekday, weekend])
+describe('decodeHourlyTile on a tile written by wsdot.py', () => {
+  const file = readFileSync(new URL('../../../testdata/wsdot/hourly-tile.bin', import.meta.url))
+  const tile = decodeHourlyTile(file.buffer.slice(file.byteOffset, file.byteOffset + file.byteLength))
+  const hours = Array.from({ length: 29 }, (_, h) => h)
+
+  it('reads the header and stop id dictionary', () => {
+    expect(tile.stopIds).toEqual(['KCM_1', 'ST_é2', 'X_3'])
+    expect(tile.planes).toBe(2)
+    expect(tile.hours).toBe(29)
+    // 300 departures in one hour does not fit a uint8
+    expect(tile.scale).toBe(2)
+  })
+
+  it('returns the counts the matrices held', () => {
+    tile.stopIds.forEach((_, i) => {
+      const weekday = hours.map(h => (i === 0 && h === 8) ? 300 : (i * 14 + h * 6) % 80)
+      expect(stopHourlyDepartures(tile, i)).toEqual(weekday)
+      expect(stopHourlyDepartures(tile, i, 'weekend')).toEqual(hours.map(h => (i + h) % 5 * 2))
+    })
+  })
+})
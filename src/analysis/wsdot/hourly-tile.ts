@@ -0,0 +1,66 @@
+// Decoder for the hourly departure tile written by docs/wsdot-python/wsdot.py
+// --hourly-tile: per-stop weekday/weekend departure counts by service-day hour,
+// precomputed in Python so a client need not re-bucket departures. No app
+// component reads tiles yet: wsdot-viewer.vue shows reports computed in the
+// browser, keyed by feedOnestopId/stopId rather than the combine_gtfs_feeds
+// prefixed stop ids of a tile, and cal/hourly-departures-chart.vue buckets a
+// route timetable's departures per service date.
+//
+// Layout (little-endian): a 24 byte header (magic 'WSHT', version, planes,
+// stops, hours, scale, idsOffset, idsLength), then each plane as `stops` rows
+// of `hours` uint8 values, then the stop ids as UTF-8 joined by newlines.
+
+const HOURLY_TILE_MAGIC = 'WSHT'
+const HOURLY_TILE_VERSION = 1
+export const HOURLY_TILE_HEADER_SIZE = 24
+
+// Planes in file order
+export const HOURLY_TILE_PLANES = ['weekday', 'weekend'] as const
+export type HourlyTilePlane = typeof HOURLY_TILE_PLANES[number]
+
+export interface HourlyTile {
+  stopIds: string[]
+  planes: number
+  hours: number
+  // Stored counts are round(departures / scale)
+  scale: number
+  counts: Uint8Array
+}
+
+export function decodeHourlyTile (buffer: ArrayBuffer): HourlyTile {
+  const view = new DataView(buffer)
+  if (buffer.byteLength < HOURLY_TILE_HEADER_SIZE) {
+    throw new Error('Hourly tile is truncated')
+  }
+  const magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3))
+  if (magic !== HOURLY_TILE_MAGIC) {
+    throw new Error('Not an hourly departure tile')
+  }
+  const version = view.getUint16(4, true)
+  if (version !== HOURLY_TILE_VERSION) {
+    throw new Error(`Unsupported hourly tile version: ${version}`)
+  }
+  const planes = view.getUint16(6, true)
+  const stops = view.getUint32(8, true)
+  const hours = view.getUint16(12, true)
+  const scale = view.getUint16(14, true)
+  const idsOffset = view.getUint32(16, true)
+  const idsLength = view.getUint32(20, true)
+  if (idsOffset + idsLength > buffer.byteLength) {
+    throw new Error('Hourly tile is truncated')
+  }
+  const ids = new TextDecoder().decode(new Uint8Array(buffer, idsOffset, idsLength))
+  return {
+    stopIds: stops > 0 ? ids.split('\n') : [],
+    planes,
+    hours,
+    scale,
+    counts: new Uint8Array(buffer, HOURLY_TILE_HEADER_SIZE, planes * stops * hours),
+  }
+}
+
+// Departures per service-day hour for one stop index
+export function stopHourlyDepartures (tile: HourlyTile, stopIndex: number, plane: HourlyTilePlane = 'weekday'): number[] {
+  const start = (HOURLY_TILE_PLANES.indexOf(plane) * tile.stopIds.length + stopIndex) * tile.hours
+  return Array.from(tile.counts.subarray(start, start + tile.hours), count => count * tile.scale)
+}
@@ -19,6 +19,7 @@ import {
 // Re-export the public service-level config so consumers (e.g. wsdot-viewer.vue)
 // keep importing it from ~~/src/analysis/wsdot.
 export { SERVICE_LEVELS, levelColors, type LevelKey } from './service-levels'
+export { decodeHourlyTile, stopHourlyDepartures, HOURLY_TILE_PLANES, type HourlyTile, type HourlyTilePlane } from './hourly-tile'
 
 // Constants for progress updates
 const PROGRESS_LIMIT_STOPS = 1000
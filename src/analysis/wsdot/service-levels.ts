@@ -4,6 +4,7 @@
 // inputs are the frequency maps built by extractFrequencyData.
 
 import type { StopTimeCacheItem, RouteGql } from '~~/src/tl'
+import levelDefinitions from './service-levels.json'
 
 // Service level configuration matching Python implementation
 interface ServiceLevelConfig {
@@ -32,70 +33,59 @@ interface NightSegmentConfig {
 export type LevelKey = 'level1' | 'level2' | 'level3' | 'level4' | 'level5' | 'level6' | 'levelNights' | 'levelAll'
 
 const ALL_HOURS = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23]
-const PEAK_HOURS = [9, 10, 11, 12, 13, 14, 15, 16]
-const EXTENDED_HOURS = [6, 7, 8, 17, 18, 19, 20, 21]
-
-export const SERVICE_LEVELS: Record<LevelKey, ServiceLevelConfig> = {
-  level1: {
-    name: 'Level 1',
-    description: 'Level 1',
-    peak: { hours: PEAK_HOURS, min_tph: 4, min_total: 40 },
-    extended: { hours: EXTENDED_HOURS, min_tph: 3, min_total: 32 },
-    weekend: { hours: PEAK_HOURS, min_tph: 3, min_total: 32 },
-    nightSegments: [
-      { hours: [23, 0], min_total: 0 },
-      { hours: [1, 2], min_total: 0 },
-      { hours: [3, 4], min_total: 0 },
-      { hours: [2, 3], min_total: 0 }
-    ],
-  },
-  level2: {
-    name: 'Level 2',
-    description: 'Level 2',
-    peak: { hours: PEAK_HOURS, min_tph: 3, min_total: 32 },
-    extended: { hours: EXTENDED_HOURS, min_tph: 1, min_total: 16 },
-    weekend: { hours: PEAK_HOURS, min_tph: 1, min_total: 16 },
-  },
-  level3: {
-    name: 'Level 3',
-    description: 'Level 3',
-    peak: { hours: PEAK_HOURS, min_tph: 1, min_total: 16 },
-    extended: { hours: EXTENDED_HOURS, min_tph: 0, min_total: 8 },
-    weekend: { hours: PEAK_HOURS, min_tph: 0, min_total: 8 },
-  },
-  level4: {
-    name: 'Level 4',
-    description: 'Level 4',
-    peak: { hours: PEAK_HOURS, min_tph: 0, min_total: 8 },
-  },
-  level5: {
-    name: 'Level 5',
-    description: 'Level 5',
-    any: { hours: ALL_HOURS, min_tph: 0, min_total: 6 },
-  },
-  level6: {
-    name: 'Level 6',
-    description: 'Level 6',
-    any: { hours: ALL_HOURS, min_tph: 0, min_total: 2 },
-  },
-  levelNights: {
-    name: 'Night',
-    description: 'Night service',
-    peak: { hours: ALL_HOURS, min_tph: 0, min_total: 4 },
-    nightSegments: [
-      { hours: [23, 0], min_total: 1 },
-      { hours: [1, 2], min_total: 1 },
-      { hours: [3, 4], min_total: 1 },
-      { hours: [2, 3], min_total: 1 }
-    ],
-  },
-  levelAll: {
-    name: 'All stops',
-    description: 'All stops in the scenario',
-    any: { hours: ALL_HOURS, min_tph: 0, min_total: 0 },
-  },
+
+// Level definitions shared with docs/wsdot-python/wsdot.py. Hours there are
+// service-day hours (24-28 run after midnight) and levels 5/6/All are route
+// total-trip thresholds; both are mapped onto the clock-hour configs below.
+interface LevelDefinition {
+  name: string
+  description: string
+  peak?: TimeConfig
+  extended?: TimeConfig
+  weekend?: TimeConfig
+  night_segments?: NightSegmentConfig[]
+  total_trips_threshold?: number
+  weekend_required?: boolean
+}
+
+// Sorted so routeHourCompatMode still checks the last clock hour of a window
+function clockHours (hours: number[]): number[] {
+  return [...new Set(hours.map(h => h % 24))].sort((a, b) => a - b)
+}
+
+function toTimeConfig (window: TimeConfig): TimeConfig {
+  return { hours: clockHours(window.hours), min_tph: window.min_tph, min_total: window.min_total }
 }
 
+function toServiceLevelConfig (definition: LevelDefinition): ServiceLevelConfig {
+  const config: ServiceLevelConfig = { name: definition.name, description: definition.description }
+  if (definition.peak) {
+    config.peak = toTimeConfig(definition.peak)
+  }
+  if (definition.extended) {
+    config.extended = toTimeConfig(definition.extended)
+  }
+  if (definition.weekend) {
+    config.weekend = toTimeConfig(definition.weekend)
+  }
+  if (definition.night_segments) {
+    config.nightSegments = definition.night_segments.map(segment => ({ hours: segment.hours.map(h => h % 24), min_total: segment.min_total }))
+  }
+  if (definition.total_trips_threshold !== undefined) {
+    config.any = { hours: ALL_HOURS, min_tph: 0, min_total: definition.total_trips_threshold }
+  }
+  if (definition.weekend_required !== undefined) {
+    config.weekendRequired = definition.weekend_required
+  }
+  return config
+}
+
+const LEVEL_DEFINITIONS: Record<LevelKey, LevelDefinition> = levelDefinitions.levels
+
+export const SERVICE_LEVELS = Object.fromEntries(
+  Object.entries(LEVEL_DEFINITIONS).map(([key, definition]) => [key, toServiceLevelConfig(definition)])
+) as Record<LevelKey, ServiceLevelConfig>
+
 export const levelColors: Record<LevelKey, string> = {
   level1: '#00ffff',
   level2: '#00ff80',